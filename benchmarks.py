@@ -0,0 +1,126 @@
+import argparse
+import time
+
+import numpy as np
+from scipy.stats import entropy
+
+from src.entropy import (
+    entropy_of_distributions,
+    get_pattern_distributions_from_indices,
+)
+from src.pattern import get_word_indices, load_pattern_grid
+from src.pattern_utils import (
+    generate_pattern_matrix,
+    generate_pattern_matrix_with_equality_grid,
+    numba,
+)
+from src.prior import get_word_list
+
+GAME_NAMES = ["wordle", "dungleon"]
+
+# Compare the speed of implementations against their reference
+
+
+def time_function(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def benchmark_pattern_matrix(game_name, n_rows=1000):
+    """
+    Computes the patterns between n_rows guesses and the full word list of
+    the game with both pattern kernels, and checks that they agree.
+    """
+    words = get_word_list(game_name)
+    guesses = words[:n_rows]
+
+    reference, reference_time = time_function(
+        generate_pattern_matrix_with_equality_grid,
+        guesses,
+        words,
+    )
+    print(f"Pattern matrix ({len(guesses)} x {len(words)} words):")
+    print(f"  equality grid: {reference_time:.2f}s")
+
+    backends = ["numpy"]
+    if numba is not None:
+        # Compile the kernel before timing it
+        generate_pattern_matrix(guesses[:1], words[:1], backend="numba")
+        backends.append("numba")
+
+    for backend in backends:
+        result, result_time = time_function(
+            generate_pattern_matrix,
+            guesses,
+            words,
+            backend,
+        )
+        print(
+            f"  {backend}: {result_time:.2f}s, identical: {np.array_equal(reference, result)}",
+        )
+
+
+def benchmark_entropy(game_name, n_possible=263, n_repeats=10):
+    """
+    Computes the entropies of the pattern distributions of every guess, for
+    n_possible random answers with random weights, with scipy and with
+    entropy_of_distributions, and checks that they agree.
+    """
+    load_pattern_grid(game_name)
+    rng = np.random.default_rng(0)
+    allowed_indices = np.arange(len(get_word_list(game_name)))
+    answers = get_word_indices(get_word_list(game_name, short=True), game_name)
+    possible_indices = np.sort(rng.choice(answers, n_possible, replace=False))
+    weights = rng.random(n_possible)
+    distributions = get_pattern_distributions_from_indices(
+        allowed_indices,
+        possible_indices,
+        weights / weights.sum(),
+        game_name,
+    )
+
+    def repeat(function, *args):
+        return function(*args), min(
+            time_function(function, *args)[1] for _ in range(n_repeats)
+        )
+
+    def scipy_entropies(distributions):
+        return entropy(distributions, base=2, axis=1)
+
+    reference, reference_time = repeat(scipy_entropies, distributions)
+    print(f"Entropies ({len(allowed_indices)} guesses x {n_possible} answers):")
+    print(f"  scipy: {reference_time * 1000:.1f}ms")
+    for dtype in (np.float64, np.float32):
+        result, result_time = repeat(entropy_of_distributions, distributions, dtype)
+        print(
+            f"  {np.dtype(dtype).name}: {result_time * 1000:.1f}ms, "
+            f"max error: {np.abs(result - reference).max():.1e}",
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--game-name",
+        type=str,
+        choices=GAME_NAMES,
+        default="wordle",
+        help="Game name",
+    )
+    parser.add_argument(
+        "--n-rows",
+        type=int,
+        default=1000,
+        help="Number of guesses for which patterns are computed",
+    )
+    parser.add_argument(
+        "--n-possible",
+        type=int,
+        default=263,
+        help="Number of possible answers for which entropies are computed",
+    )
+    args = parser.parse_args()
+
+    benchmark_pattern_matrix(args.game_name, n_rows=args.n_rows)
+    benchmark_entropy(args.game_name, n_possible=args.n_possible)
@@ -1,26 +1,72 @@
 import argparse
+import itertools
 import json
+import multiprocessing
 import random
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import numpy as np
 from tqdm import tqdm
 
+from src.book import build_opening_book, load_opening_book
+from src.cache import (
+    get_cached_decision,
+    get_configuration_key,
+    get_fingerprint,
+    open_decision_cache,
+    set_cached_decision,
+)
+from src.exact import build_exact_decision_tree
 from src.file import get_simulation_results_folder
 from src.pattern import (
-    get_pattern,
-    get_possible_words,
+    ALL_GREEN,
+    add_words,
+    get_index_buckets,
+    get_pattern_from_indices,
+    get_possible_indices,
+    get_possible_mask,
+    get_word_indices,
+    load_pattern_grid,
     pattern_to_int_list,
     patterns_to_string,
 )
-from src.prior import get_frequency_based_priors, get_true_wordle_prior, get_word_list
-from src.solver import brute_force_optimal_guess, optimal_guess
+from src.pattern_utils import (
+    PATTERN_BACKENDS,
+    get_pattern_backend,
+    set_pattern_backend,
+)
+from src.prior import (
+    get_frequency_based_prior_array,
+    get_prior_array,
+    get_true_wordle_prior_array,
+    get_word_list,
+)
+from src.solver import (
+    brute_force_optimal_guess_from_indices,
+    optimal_guess,
+    optimal_guess_from_indices,
+)
 
 GAME_NAMES = ["wordle", "dungleon"]
 
+# Minimum number of seconds between two updates of the terminal output
+REFRESH_INTERVAL = 0.1
+
 # Run simulated wordle games
 
 
+def simulate_shard(kwargs):
+    return simulate_games(**kwargs)
+
+
+def get_score_distribution(game_results):
+    scores = [result["score"] for result in game_results]
+    return np.bincount(scores, minlength=1)[1:].tolist()
+
+
 def simulate_games(
     game_name,
     first_guess=None,
@@ -38,154 +84,415 @@ def simulate_games(
     results_file=None,
     next_guess_map_file=None,
     quiet=False,
+    n_grid_workers=1,
+    pattern_backend=None,
+    use_opening_book=True,
+    n_workers=1,
+    display_progress=True,
+    use_decision_tree=False,
+    use_decision_cache=True,
+    search_depth=None,
+    beam_width=25,
+    time_budget=None,
+    node_budget=None,
 ):
+    if pattern_backend is not None:
+        set_pattern_backend(pattern_backend)
+    load_pattern_grid(game_name, n_workers=n_grid_workers)
     all_words = get_word_list(game_name, short=False)
     short_word_list = get_word_list(game_name, short=True)
+    all_indices = np.arange(len(all_words))
+
+    if priors is None:
+        priors = get_frequency_based_prior_array(game_name, dtype=float)
+    prior_array = get_prior_array(priors, game_name)
+
+    # The opening book does not apply when the possibilities depend on the
+    # previous games, or to the brute-force and search solvers.
+    if (
+        use_opening_book
+        and second_guess_map is None
+        and not exclude_seen_words
+        and not brute_force_optimize
+        and search_depth is None
+    ):
+        opening_book = load_opening_book(
+            game_name,
+            prior_array,
+            look_two_ahead=look_two_ahead,
+            optimize_for_uniform_distribution=optimize_for_uniform_distribution,
+            purely_maximize_information=purely_maximize_information,
+            hard_mode=hard_mode,
+            beam_width=beam_width,
+        )
+        if opening_book is not None:
+            if first_guess is None:
+                first_guess = opening_book["first_guess"]
+            if first_guess == opening_book["first_guess"]:
+                second_guess_map = opening_book["second_guess_map"]
+
+    search_settings = {
+        "search_depth": search_depth,
+        "beam_width": beam_width,
+        "time_budget": time_budget,
+        "node_budget": node_budget,
+    }
 
     if first_guess is None:
         first_guess = optimal_guess(
             all_words,
             all_words,
-            priors,
+            prior_array,
             game_name=game_name,
             look_two_ahead=look_two_ahead,
             purely_maximize_information=purely_maximize_information,
             optimize_for_uniform_distribution=optimize_for_uniform_distribution,
+            **search_settings,
         )
 
-    if priors is None:
-        priors = get_frequency_based_priors(game_name)
-
     if test_set is None or test_set[0] is None:
         test_set = short_word_list
 
     if shuffle:
         random.shuffle(test_set)
 
-    seen = set()
+    seen = np.zeros(len(all_words), dtype=bool)
 
     # Function for choosing the next guess, with a dict to cache
     # and reuse results that are seen multiple times in the sim
     next_guess_map = {}
 
-    def get_next_guess(guesses, patterns, possibilities):
-        phash = "".join(
+    # Guesses of the brute-force playouts, shared by all its decisions
+    playout_cache = {}
+
+    def choose_guess(choices, possibilities):
+        if brute_force_optimize:
+            guess_index = brute_force_optimal_guess_from_indices(
+                choices,
+                possibilities,
+                prior_array,
+                game_name,
+                n_top_picks=brute_force_depth,
+                playout_cache=playout_cache,
+            )
+            return all_words[guess_index]
+        guess_index = optimal_guess_from_indices(
+            choices,
+            possibilities,
+            prior_array,
+            game_name,
+            look_two_ahead=look_two_ahead,
+            purely_maximize_information=purely_maximize_information,
+            optimize_for_uniform_distribution=optimize_for_uniform_distribution,
+            **search_settings,
+        )
+        return all_words[guess_index]
+
+    # Decisions are also stored on disk, to be shared with other runs
+    # using the same configuration of the solver.
+    decision_cache = None
+    if use_decision_cache:
+        configuration_key = get_configuration_key(
+            game_name,
+            prior_array,
+            {
+                "look_two_ahead": look_two_ahead,
+                "optimize_for_uniform_distribution": optimize_for_uniform_distribution,
+                "purely_maximize_information": purely_maximize_information,
+                "brute_force_optimize": brute_force_optimize,
+                "brute_force_depth": brute_force_depth,
+                **search_settings,
+            },
+        )
+
+    def get_history_hash(guesses, patterns):
+        return "".join(
             str(g) + "".join(map(str, pattern_to_int_list(p)))
             for g, p in zip(guesses, patterns, strict=True)
         )
+
+    # In hard mode, the allowed guesses of each history of guesses, as a mask
+    # derived from the mask of the history without its last guess, and the
+    # row of the grid for that guess.
+    hard_mode_masks = {"": np.ones(len(all_words), dtype=bool)}
+
+    def get_hard_mode_mask(guesses, patterns):
+        phash = get_history_hash(guesses, patterns)
+        if phash not in hard_mode_masks:
+            guess_index = get_word_indices(guesses[-1:], game_name)[0]
+            hard_mode_masks[phash] = get_hard_mode_mask(
+                guesses[:-1],
+                patterns[:-1],
+            ) & get_possible_mask(guess_index, patterns[-1], game_name)
+        return hard_mode_masks[phash]
+
+    def get_next_guess(guesses, patterns, possibilities):
+        phash = get_history_hash(guesses, patterns)
         if second_guess_map is not None and len(patterns) == 1:
             next_guess_map[phash] = second_guess_map[patterns[0]]
         if phash not in next_guess_map:
-            choices = all_words
+            choices = all_indices
             if hard_mode:
-                for guess, pattern in zip(guesses, patterns, strict=True):
-                    choices = get_possible_words(guess, pattern, choices, game_name)
-            
-            if not choices:
-                # Debugging: No words remaining
-                print(f"No allowed words available after filtering for guesses: {guesses} and patterns: {patterns}")
-                raise ValueError("No allowed words available after filtering.")
-    
-            if brute_force_optimize:
-                next_guess_map[phash] = brute_force_optimal_guess(
-                    choices,
-                    possibilities,
-                    priors,
-                    game_name=game_name,
-                    n_top_picks=brute_force_depth,
-                )
-            else:
-                next_guess_map[phash] = optimal_guess(
-                    choices,
-                    possibilities,
-                    priors,
-                    game_name,
-                    look_two_ahead=look_two_ahead,
-                    purely_maximize_information=purely_maximize_information,
-                    optimize_for_uniform_distribution=optimize_for_uniform_distribution,
+                choices = np.flatnonzero(get_hard_mode_mask(guesses, patterns))
+
+            if len(choices) == 0:
+                msg = f"No allowed words available after filtering for guesses: {guesses} and patterns: {patterns}"
+                raise ValueError(msg)
+
+            # The persistent cache is keyed by the candidate sets, since the
+            # same state can be reached through different histories.
+            guess = None
+            if decision_cache is not None:
+                decision_key = ":".join(
+                    (
+                        configuration_key,
+                        get_fingerprint(choices),
+                        get_fingerprint(possibilities),
+                    ),
                 )
+                guess = get_cached_decision(decision_cache, decision_key)
+            if guess is None:
+                guess = choose_guess(choices, possibilities)
+                if decision_cache is not None:
+                    set_cached_decision(decision_cache, decision_key, guess)
+            next_guess_map[phash] = guess
         return next_guess_map[phash]
 
-
     # Go through each answer in the test set, play the game,
     # and keep track of the stats.
-    scores = np.zeros(0, dtype=int)
     game_results = []
     score_dist = []
     total_guesses = 0
-    for answer in tqdm(
-        test_set,
-        leave=False,
-        desc=" Trying all wordle answers",
-    ):
-        guesses = []
-        patterns = []
-        possibility_counts = []
-        possibilities = list(filter(lambda w: priors[w] > 0, all_words))
-
+    decision_tree = None
+    # The connection to the decision cache is only opened when the games are
+    # played in this process, since a SQLite connection must not be carried
+    # across the fork of the shard workers, which open their own.
+    if use_decision_cache and (use_decision_tree or n_workers <= 1):
+        decision_cache = open_decision_cache(game_name)
+    if use_decision_tree:
         if exclude_seen_words:
-            possibilities = list(filter(lambda w: w not in seen, possibilities))
-
-        score = 1
-        guess = first_guess
-        while guess != answer:
-            pattern = get_pattern(guess, answer, game_name)
-            guesses.append(guess)
-            patterns.append(pattern)
-            possibilities = get_possible_words(guess, pattern, possibilities, game_name)
-            possibility_counts.append(len(possibilities))
-            score += 1
-            guess = get_next_guess(guesses, patterns, possibilities)
-
-        # Accumulate stats
-        scores = np.append(scores, [score])
-        score_dist = [
-            int((scores == i).sum()) for i in range(1, scores.max(initial=0) + 1)
+            msg = "Excluding seen words requires playing the games one by one."
+            raise ValueError(msg)
+        # Rather than replaying each answer, walk the tree of decisions
+        # breadth-first: each node is a game state, where the answers of the
+        # test set which lead to it are split into buckets by the pattern of
+        # the guess, and each bucket becomes a child node.
+        test_indices = get_word_indices(test_set, game_name)
+        results_by_answer = {}
+        decision_tree = {"guess": first_guess, "children": {}}
+        queue = deque(
+            [
+                (
+                    decision_tree,
+                    [],
+                    [],
+                    [],
+                    np.flatnonzero(prior_array > 0),
+                    test_indices,
+                ),
+            ],
+        )
+        progress = tqdm(
+            total=len(test_set),
+            leave=False,
+            desc=" Walking the decision tree",
+            disable=not display_progress,
+        )
+        while queue:
+            node, guesses, patterns, possibility_counts, possibilities, answers = (
+                queue.popleft()
+            )
+            guess = node["guess"]
+            guess_index = get_word_indices([guess], game_name)[0]
+            buckets = get_index_buckets(guess_index, answers, game_name)
+            for pattern, bucket in enumerate(buckets):
+                if len(bucket) == 0:
+                    continue
+                if pattern == ALL_GREEN:
+                    # The guess is the answer
+                    results_by_answer[guess_index] = {
+                        "score": len(guesses) + 1,
+                        "answer": guess,
+                        "guesses": guesses,
+                        "patterns": list(map(int, patterns)),
+                        "reductions": possibility_counts,
+                    }
+                    progress.update()
+                    continue
+                child_possibilities = get_possible_indices(
+                    guess_index,
+                    pattern,
+                    possibilities,
+                    game_name,
+                )
+                child_guesses = [*guesses, guess]
+                child_patterns = [*patterns, pattern]
+                child = {
+                    "guess": get_next_guess(
+                        child_guesses,
+                        child_patterns,
+                        child_possibilities,
+                    ),
+                    "children": {},
+                }
+                node["children"][pattern] = child
+                queue.append(
+                    (
+                        child,
+                        child_guesses,
+                        child_patterns,
+                        [*possibility_counts, len(child_possibilities)],
+                        child_possibilities,
+                        bucket,
+                    ),
+                )
+        progress.close()
+        game_results = [results_by_answer[i] for i in test_indices]
+        score_dist = get_score_distribution(game_results)
+        total_guesses = sum(result["score"] for result in game_results)
+    elif n_workers > 1:
+        if exclude_seen_words:
+            msg = "Excluding seen words requires playing the games sequentially."
+            raise ValueError(msg)
+        # The workers play contiguous shards of the test set with the
+        # settings resolved above, and their results are merged in order.
+        shard_kwargs = {
+            "game_name": game_name,
+            "first_guess": first_guess,
+            "priors": prior_array,
+            "look_two_ahead": look_two_ahead,
+            "optimize_for_uniform_distribution": optimize_for_uniform_distribution,
+            "second_guess_map": second_guess_map,
+            "hard_mode": hard_mode,
+            "purely_maximize_information": purely_maximize_information,
+            "brute_force_optimize": brute_force_optimize,
+            "brute_force_depth": brute_force_depth,
+            "quiet": True,
+            "pattern_backend": get_pattern_backend(),
+            "use_opening_book": False,
+            "display_progress": False,
+            "use_decision_cache": use_decision_cache,
+            **search_settings,
+        }
+        n_shards = min(n_workers, len(test_set))
+        bounds = np.linspace(0, len(test_set), n_shards + 1).astype(int)
+        shards = [
+            {**shard_kwargs, "test_set": list(test_set[start:end])}
+            for start, end in itertools.pairwise(bounds)
         ]
-        total_guesses = scores.sum()
-        average = scores.mean()
-        seen.add(answer)
+        # Workers are spawned rather than forked, since forking a process whose
+        # numba thread pool is running deadlocks. They map the same grid file,
+        # which is shared through the page cache.
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as executor:
+            for shard_result, shard_map in tqdm(
+                executor.map(simulate_shard, shards),
+                total=n_shards,
+                leave=False,
+                desc=" Trying all wordle answers",
+                disable=not display_progress,
+            ):
+                game_results.extend(shard_result["game_results"])
+                next_guess_map.update(shard_map)
+        score_dist = get_score_distribution(game_results)
+        total_guesses = sum(result["score"] for result in game_results)
+    else:
+        last_render = None
+        for i, answer in enumerate(
+            tqdm(
+                test_set,
+                leave=False,
+                desc=" Trying all wordle answers",
+                disable=not display_progress,
+            ),
+        ):
+            answer_index = get_word_indices([answer], game_name)[0]
+            guesses = []
+            patterns = []
+            possibility_counts = []
+            possibilities = np.flatnonzero(prior_array > 0)
 
-        game_results.append(
-            {
-                "score": int(score),
-                "answer": answer,
-                "guesses": guesses,
-                "patterns": list(map(int, patterns)),
-                "reductions": possibility_counts,
-            },
-        )
-        # Print outcome
-        if not quiet:
-            message = "\n".join(
-                [
-                    "",
-                    f"Score: {score}",
-                    f"Answer: {answer}",
-                    f"Guesses: {guesses}",
-                    f"Reductions: {possibility_counts}",
-                    *patterns_to_string((*patterns, 3**5 - 1)).split("\n"),
-                    *" " * (6 - len(patterns)),
-                    f"Distribution: {score_dist}",
-                    f"Total guesses: {total_guesses}",
-                    f"Average: {average}",
-                    *" " * 2,
-                ],
+            if exclude_seen_words:
+                possibilities = possibilities[~seen[possibilities]]
+
+            score = 1
+            guess = first_guess
+            while guess != answer:
+                guess_index = get_word_indices([guess], game_name)[0]
+                pattern = get_pattern_from_indices(guess_index, answer_index, game_name)
+                guesses.append(guess)
+                patterns.append(pattern)
+                possibilities = get_possible_indices(
+                    guess_index,
+                    pattern,
+                    possibilities,
+                    game_name,
+                )
+                possibility_counts.append(len(possibilities))
+                score += 1
+                guess = get_next_guess(guesses, patterns, possibilities)
+
+            # Accumulate stats, in constant time per game
+            if score > len(score_dist):
+                score_dist.extend([0] * (score - len(score_dist)))
+            score_dist[score - 1] += 1
+            total_guesses += score
+            average = total_guesses / (i + 1)
+            seen[answer_index] = True
+
+            game_results.append(
+                {
+                    "score": int(score),
+                    "answer": answer,
+                    "guesses": guesses,
+                    "patterns": list(map(int, patterns)),
+                    "reductions": possibility_counts,
+                },
             )
-            if answer is not test_set[0]:
-                # Move cursor back up to the top of the message
-                n = len(message.split("\n")) + 1
-                print("\033[F\033[K" * n)
-            else:
-                print("\r\033[K\n")
-            print(message)
+            # Print outcome, at most once per refresh interval
+            now = time.monotonic()
+            if not quiet and (
+                last_render is None
+                or now - last_render >= REFRESH_INTERVAL
+                or i == len(test_set) - 1
+            ):
+                message = "\n".join(
+                    [
+                        "",
+                        f"Score: {score}",
+                        f"Answer: {answer}",
+                        f"Guesses: {guesses}",
+                        f"Reductions: {possibility_counts}",
+                        *patterns_to_string((*patterns, ALL_GREEN)).split("\n"),
+                        *" " * (6 - len(patterns)),
+                        f"Distribution: {score_dist}",
+                        f"Total guesses: {total_guesses}",
+                        f"Average: {average}",
+                        *" " * 2,
+                    ],
+                )
+                if last_render is not None:
+                    # Move cursor back up to the top of the message
+                    n = len(message.split("\n")) + 1
+                    print("\033[F\033[K" * n)
+                else:
+                    print("\r\033[K\n")
+                print(message)
+                last_render = now
 
     final_result = {
         "score_distribution": score_dist,
         "total_guesses": int(total_guesses),
-        "average_score": float(scores.mean()),
+        "average_score": total_guesses / len(game_results),
         "game_results": game_results,
     }
+    if decision_tree is not None:
+        final_result["decision_tree"] = decision_tree
+
+    if decision_cache is not None:
+        decision_cache.close()
 
     # Save results
     for obj, file in (
@@ -255,17 +562,127 @@ if __name__ == "__main__":
         action="store_true",
         help="Play the hard mode",
     )
+    parser.add_argument(
+        "--grid-workers",
+        type=int,
+        default=None,
+        help="Number of processes generating the pattern matrix (default: all cores)",
+    )
+    parser.add_argument(
+        "--pattern-backend",
+        type=str,
+        choices=PATTERN_BACKENDS,
+        default=None,
+        help="Backend computing patterns (default: numba if installed)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes playing the games",
+    )
+    parser.add_argument(
+        "--decision-tree",
+        dest="use_decision_tree",
+        action="store_true",
+        help="Build the tree of decisions instead of replaying each answer",
+    )
+    parser.add_argument(
+        "--no-decision-cache",
+        dest="use_decision_cache",
+        action="store_false",
+        help="Do not read or write the decisions cached on disk",
+    )
+    parser.add_argument(
+        "--build-opening-book",
+        action="store_true",
+        help="Precompute the first and second guesses, and save them to file",
+    )
+    parser.add_argument(
+        "--search-depth",
+        type=int,
+        default=None,
+        help="Number of guesses to look ahead with a search (default: no search)",
+    )
+    parser.add_argument(
+        "--beam-width",
+        type=int,
+        default=25,
+        help="Number of guesses played out at each step of the look-ahead",
+    )
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        default=None,
+        help="Maximum number of seconds spent searching each decision",
+    )
+    parser.add_argument(
+        "--node-budget",
+        type=int,
+        default=None,
+        help="Maximum number of guesses played out when searching each decision",
+    )
+    parser.add_argument(
+        "--add-words",
+        nargs="+",
+        metavar="WORD",
+        default=None,
+        help="Append words to the word list and the pattern matrix, instead of simulating",
+    )
+    parser.add_argument(
+        "--exact",
+        action="store_true",
+        help="Find the optimal decision tree, and save it to file, instead of simulating",
+    )
     args = parser.parse_args()
 
-    results, decision_map = simulate_games(
-        game_name=args.game_name,
-        first_guess=args.first_guess,
-        test_set=[args.test_answer],
-        priors=get_true_wordle_prior(args.game_name),
-        purely_maximize_information=args.purely_maximize_information,
-        optimize_for_uniform_distribution=args.optimize_for_uniform_distribution,
-        look_two_ahead=args.look_two_ahead,
-        shuffle=args.shuffle,
-        brute_force_optimize=args.brute_force_optimize,
-        hard_mode=args.hard_mode,
-    )
+    if args.add_words:
+        added_words = add_words(args.game_name, args.add_words)
+        print(f"Added {len(added_words)} words to the word list and pattern matrix")
+        # Adding words is a maintenance command of its own, not a simulation
+        parser.exit()
+
+    if args.build_opening_book:
+        if args.pattern_backend is not None:
+            set_pattern_backend(args.pattern_backend)
+        load_pattern_grid(args.game_name, n_workers=args.grid_workers)
+        build_opening_book(
+            args.game_name,
+            get_true_wordle_prior_array(args.game_name),
+            look_two_ahead=args.look_two_ahead,
+            optimize_for_uniform_distribution=args.optimize_for_uniform_distribution,
+            purely_maximize_information=args.purely_maximize_information,
+            hard_mode=args.hard_mode,
+            beam_width=args.beam_width,
+        )
+
+    if args.exact:
+        result = build_exact_decision_tree(
+            args.game_name,
+            first_guess=args.first_guess,
+            n_workers=args.workers,
+        )
+        print(f"Total guesses: {result['total_guesses']}")
+        print(f"Average: {result['average_score']}")
+    else:
+        results, decision_map = simulate_games(
+            game_name=args.game_name,
+            first_guess=args.first_guess,
+            test_set=[args.test_answer],
+            priors=get_true_wordle_prior_array(args.game_name),
+            purely_maximize_information=args.purely_maximize_information,
+            optimize_for_uniform_distribution=args.optimize_for_uniform_distribution,
+            look_two_ahead=args.look_two_ahead,
+            shuffle=args.shuffle,
+            brute_force_optimize=args.brute_force_optimize,
+            hard_mode=args.hard_mode,
+            n_grid_workers=args.grid_workers,
+            pattern_backend=args.pattern_backend,
+            n_workers=args.workers,
+            use_decision_tree=args.use_decision_tree,
+            use_decision_cache=args.use_decision_cache,
+            search_depth=args.search_depth,
+            beam_width=args.beam_width,
+            time_budget=args.time_budget,
+            node_budget=args.node_budget,
+        )
@@ -1,30 +1,184 @@
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any
+
 import numpy as np
+from tqdm import tqdm
+
+from src.pattern_utils import (
+    generate_pattern_matrix,
+    get_pattern_backend,
+    set_pattern_threads,
+)
+
+# Peak number of bytes allocated by generate_pattern_matrix per pair of words,
+# measured at ~10 bytes (a handful of uint8 bitmask grids), plus a margin.
+BYTES_PER_PAIR = 12
+MEMORY_BUDGET = 512 * 1024**2
 
-from src.pattern_utils import generate_pattern_matrix
+# To store the word list and the output grid in each worker process
+WORKER_DATA: dict[str, Any] = {}
+
+
+def get_tile_length(memory_budget=MEMORY_BUDGET):
+    """
+    Returns the side length of the square tiles of the pattern matrix which
+    can be generated without exceeding memory_budget bytes.
+    """
+    return max(1, math.isqrt(memory_budget // BYTES_PER_PAIR))
 
-CHUNK_SIZE = 13000
 
+def generate_full_pattern_matrix_in_tiles(
+    words,
+    out=None,
+    memory_budget=MEMORY_BUDGET,
+    display_progress=False,
+    backend=None,
+):
+    """
+    Fills the pattern matrix between words and themselves tile by tile.
 
-def chunks(lst, length):
-    """Yield successive n-sized chunks from lst.
-    Reference: https://stackoverflow.com/a/312464/376454
+    The output is allocated once, or written directly into out, e.g. a
+    np.memmap opened for writing, so that the peak memory is bounded by
+    memory_budget bytes on top of the output, instead of several copies
+    of the full matrix.
     """
-    for i in range(0, len(lst), length):
-        yield lst[i : i + length]
+    n = len(words)
+    if out is None:
+        out = np.empty((n, n), dtype=np.uint8)
+
+    length = get_tile_length(memory_budget)
+    for i in tqdm(
+        range(0, n, length),
+        desc="Generating pattern matrix",
+        leave=False,
+        disable=not display_progress,
+    ):
+        words1 = words[i : i + length]
+        for j in range(0, n, length):
+            words2 = words[j : j + length]
+            out[i : i + length, j : j + length] = generate_pattern_matrix(
+                words1,
+                words2,
+                backend=backend,
+            )
+        if isinstance(out, np.memmap):
+            # Write back the finished rows, so that dirty pages do not pile up
+            out.flush()
 
+    return out
 
-def generate_full_pattern_matrix_in_blocks(words, length=CHUNK_SIZE):
-    block_matrix = None
-    for words1 in chunks(words, length):
-        row = None
 
-        for words2 in chunks(words, length):
-            block = generate_pattern_matrix(words1, words2)
+def get_slices(start, stop, length):
+    return [slice(k, min(k + length, stop)) for k in range(start, stop, length)]
 
-            row = np.hstack((row, block)) if row is not None else block
 
-        block_matrix = (
-            np.vstack((block_matrix, row)) if block_matrix is not None else row
+def generate_new_pattern_matrix_tiles(words, n_old, out, memory_budget=MEMORY_BUDGET):
+    """
+    Fills the rows and columns of the pattern matrix between words and
+    themselves which belong to the words after the first n_old, tile by tile.
+    The patterns between the first n_old words, already in out, are kept.
+    """
+    n = len(words)
+    length = get_tile_length(memory_budget)
+    # The new columns of every row, then the old columns of the new rows
+    tiles = [
+        (rows, cols)
+        for rows in get_slices(0, n, length)
+        for cols in get_slices(n_old, n, length)
+    ]
+    tiles += [
+        (rows, cols)
+        for rows in get_slices(n_old, n, length)
+        for cols in get_slices(0, n_old, length)
+    ]
+    for rows, cols in tiles:
+        out[rows, cols] = generate_pattern_matrix(words[rows], words[cols])
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+
+def get_tiles(n, length):
+    return [(i, j) for i in range(0, n, length) for j in range(0, n, length)]
+
+
+def init_tile_worker(words, fname, length, backend):
+    # The workers already span the cores
+    set_pattern_threads(1)
+    WORKER_DATA["words"] = words
+    WORKER_DATA["grid"] = np.load(fname, mmap_mode="r+")
+    WORKER_DATA["length"] = length
+    WORKER_DATA["backend"] = backend
+
+
+def fill_tile(i, j):
+    words = WORKER_DATA["words"]
+    grid = WORKER_DATA["grid"]
+    length = WORKER_DATA["length"]
+    grid[i : i + length, j : j + length] = generate_pattern_matrix(
+        words[i : i + length],
+        words[j : j + length],
+        backend=WORKER_DATA["backend"],
+    )
+    grid.flush()
+
+
+def generate_full_pattern_matrix_in_parallel(
+    words,
+    fname,
+    n_workers=None,
+    memory_budget=MEMORY_BUDGET,
+    display_progress=True,
+    backend=None,
+):
+    """
+    Writes the pattern matrix between words and themselves into the .npy file
+    fname, splitting the grid into tiles which are computed by a pool of
+    n_workers processes. Each worker maps the output file, so that tiles are
+    written in place rather than sent back to the parent process.
+
+    The memory budget is shared between the workers.
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    if backend is None:
+        backend = get_pattern_backend()
+    n = len(words)
+
+    # Allocate the output file once, then fill it
+    grid = np.lib.format.open_memmap(fname, mode="w+", dtype=np.uint8, shape=(n, n))
+    if n_workers == 1:
+        generate_full_pattern_matrix_in_tiles(
+            words,
+            out=grid,
+            memory_budget=memory_budget,
+            display_progress=display_progress,
+            backend=backend,
         )
+        return
+    del grid
 
-    return block_matrix
+    length = get_tile_length(memory_budget // n_workers)
+    tiles = get_tiles(n, length)
+    progress = tqdm(
+        total=len(tiles),
+        desc="Generating pattern matrix",
+        leave=False,
+        disable=not display_progress,
+    )
+    # Workers are spawned rather than forked, since forking a process whose
+    # numba thread pool is running deadlocks
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_tile_worker,
+        initargs=(words, fname, length, backend),
+    ) as executor:
+        futures = [executor.submit(fill_tile, i, j) for i, j in tiles]
+        for future in as_completed(futures):
+            future.result()
+            progress.update()
+    progress.close()
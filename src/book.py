@@ -0,0 +1,149 @@
+import json
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+from src.cache import SOLVER_VERSION, get_configuration_key
+from src.file import get_opening_book_fname
+from src.pattern import (
+    get_indexed_words,
+    get_possible_indices,
+    load_pattern_grid,
+)
+from src.prior import get_prior_array, get_word_list
+from src.solver import optimal_guess_from_indices
+
+# Opening books store the first guess, and the best reply to each pattern, for
+# a given configuration of the solver, so that simulations can skip the two
+# most expensive decisions.
+
+
+def get_opening_book_key(
+    game_name,
+    priors,
+    look_two_ahead=False,
+    optimize_for_uniform_distribution=False,
+    purely_maximize_information=False,
+    hard_mode=False,
+    beam_width=25,
+):
+    """
+    Returns a hash of the word lists of the game, the priors and the settings
+    of the solver, which identifies the opening book of that configuration.
+    """
+    settings = {
+        "look_two_ahead": look_two_ahead,
+        "optimize_for_uniform_distribution": optimize_for_uniform_distribution,
+        "purely_maximize_information": purely_maximize_information,
+        "hard_mode": hard_mode,
+        "beam_width": beam_width,
+    }
+    return get_configuration_key(game_name, priors, settings)
+
+
+def build_opening_book(
+    game_name,
+    priors,
+    look_two_ahead=False,
+    optimize_for_uniform_distribution=False,
+    purely_maximize_information=False,
+    hard_mode=False,
+    beam_width=25,
+):
+    """
+    Computes the first guess, as well as the second guess for each of the
+    patterns which the first guess can produce, as simulate_games would,
+    and saves them to file.
+    """
+    load_pattern_grid(game_name)
+    all_words = get_word_list(game_name)
+    all_indices = np.arange(len(all_words))
+    prior_array = get_prior_array(priors, game_name)
+    settings = {
+        "look_two_ahead": look_two_ahead,
+        "optimize_for_uniform_distribution": optimize_for_uniform_distribution,
+        "purely_maximize_information": purely_maximize_information,
+        "beam_width": beam_width,
+    }
+
+    first_guess = optimal_guess_from_indices(
+        all_indices,
+        all_indices,
+        prior_array,
+        game_name,
+        **settings,
+    )
+
+    possibilities = np.flatnonzero(prior_array > 0)
+    second_guess_map = {}
+    for pattern in tqdm(range(3**5), leave=False, desc="Building opening book"):
+        bucket = get_possible_indices(first_guess, pattern, possibilities, game_name)
+        if len(bucket) == 0:
+            continue
+        choices = all_indices
+        if hard_mode:
+            choices = get_possible_indices(first_guess, pattern, choices, game_name)
+        second_guess_map[pattern] = optimal_guess_from_indices(
+            choices,
+            bucket,
+            prior_array,
+            game_name,
+            **settings,
+        )
+
+    opening_book = {
+        "solver_version": SOLVER_VERSION,
+        "first_guess": all_words[first_guess],
+        "second_guess_map": dict(
+            zip(
+                second_guess_map.keys(),
+                get_indexed_words(second_guess_map.values(), game_name),
+                strict=True,
+            ),
+        ),
+    }
+
+    key = get_opening_book_key(game_name, prior_array, hard_mode=hard_mode, **settings)
+    fname = Path(get_opening_book_fname(game_name, key))
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    with fname.open("w", encoding="utf8") as fp:
+        json.dump(opening_book, fp)
+    return opening_book
+
+
+def load_opening_book(
+    game_name,
+    priors,
+    look_two_ahead=False,
+    optimize_for_uniform_distribution=False,
+    purely_maximize_information=False,
+    hard_mode=False,
+    beam_width=25,
+):
+    """
+    Returns the opening book saved for this configuration, or None if it has
+    not been built, or was built by another version of the solver. Patterns
+    are converted back to integers.
+    """
+    key = get_opening_book_key(
+        game_name,
+        priors,
+        look_two_ahead=look_two_ahead,
+        optimize_for_uniform_distribution=optimize_for_uniform_distribution,
+        purely_maximize_information=purely_maximize_information,
+        hard_mode=hard_mode,
+        beam_width=beam_width,
+    )
+    fname = Path(get_opening_book_fname(game_name, key))
+    if not fname.exists():
+        return None
+    with fname.open(encoding="utf8") as fp:
+        opening_book = json.load(fp)
+    if opening_book.get("solver_version") != SOLVER_VERSION:
+        return None
+    opening_book["second_guess_map"] = {
+        int(pattern): guess
+        for pattern, guess in opening_book["second_guess_map"].items()
+    }
+    return opening_book
@@ -0,0 +1,69 @@
+import hashlib
+import json
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+
+from src.file import get_decision_cache_fname
+from src.prior import get_prior_array, get_word_list
+
+# Keys identifying a solver configuration and a game state, and a persistent
+# cache of the decisions taken by the solver, shared across runs.
+
+# Version of the solver, to be bumped whenever a change of the solver can
+# alter its decisions, so that the decisions saved by earlier versions are
+# not served anymore
+SOLVER_VERSION = 1
+
+
+def get_configuration_key(game_name, priors, settings):
+    """
+    Returns a hash of the word lists of the game, the priors, and the version
+    and the settings of the solver.
+    """
+    digest = hashlib.sha256()
+    for short in (False, True):
+        digest.update("\n".join(get_word_list(game_name, short=short)).encode())
+    digest.update(np.ascontiguousarray(get_prior_array(priors, game_name)).tobytes())
+    settings = {**settings, "solver_version": SOLVER_VERSION}
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+    return digest.hexdigest()[:16]
+
+
+def get_fingerprint(indices):
+    """
+    Returns a hash of an array of word indices, e.g. a set of candidates.
+    """
+    indices = np.ascontiguousarray(indices, dtype=np.int64)
+    return hashlib.sha256(indices.tobytes()).hexdigest()[:16]
+
+
+def open_decision_cache(game_name):
+    fname = Path(get_decision_cache_fname(game_name))
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(fname, timeout=60)
+    # Let parallel simulations read while one of them writes
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS decisions (key TEXT PRIMARY KEY, guess TEXT)",
+    )
+    connection.commit()
+    return connection
+
+
+def get_cached_decision(connection, key):
+    row = connection.execute(
+        "SELECT guess FROM decisions WHERE key = ?",
+        (key,),
+    ).fetchone()
+    return row[0] if row is not None else None
+
+
+def set_cached_decision(connection, key, guess):
+    # Commit right away, so that an interrupted run keeps its decisions
+    connection.execute(
+        "INSERT OR REPLACE INTO decisions (key, guess) VALUES (?, ?)",
+        (key, guess),
+    )
+    connection.commit()
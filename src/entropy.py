@@ -1,62 +1,274 @@
+import math
+from typing import Any
+
 import numpy as np
-from scipy.stats import entropy
+from scipy.special import entr
 
-from src.pattern import get_pattern_matrix
+from src.pattern import get_pattern_matrix_from_indices, get_word_indices
 
-# Functions associated with entropy calculation
+# Maximum number of (guess, answer) pairs for which patterns are gathered at
+# once when computing pattern distributions
+DISTRIBUTION_CHUNK_SIZE = 2**22
 
+# Number of distributions whose entropies are computed at once, so that the
+# buffers of a block stay in cache
+ENTROPY_BLOCK_SIZE = 256
 
-def get_pattern_distributions(allowed_words, possible_words, weights, game_name):
+# Buffers reused across calls to entropy_of_distributions, by name and dtype
+ENTROPY_BUFFERS: dict[tuple[str, str], Any] = {}
+
+# Functions associated with entropy calculation. They work on indices of words
+# in the word list of the game, with wrappers taking lists of words.
+
+
+def get_distributions_from_patterns(pattern_matrix, weights):
+    """
+    Sums the weights of the columns of pattern_matrix which share the same
+    pattern, for each row, with a single scatter-add over the whole matrix.
     """
-    For each possible guess in allowed_words, this finds the probability
+    n = len(pattern_matrix)
+    # Index of the (row, pattern) bucket of each entry in the flattened output
+    indices = pattern_matrix + (3**5 * np.arange(n))[:, np.newaxis]
+    distributions = np.bincount(
+        indices.ravel(),
+        weights=np.broadcast_to(weights, pattern_matrix.shape).ravel(),
+        minlength=n * 3**5,
+    )
+    return distributions.reshape((n, 3**5))
+
+
+def get_pattern_distributions_from_indices(
+    allowed_indices,
+    possible_indices,
+    weights,
+    game_name,
+    chunk_size=DISTRIBUTION_CHUNK_SIZE,
+):
+    """
+    For each possible guess in allowed_indices, this finds the probability
     distribution across all the 3^5 wordle patterns you could see, assuming
-    the possible answers are in possible_words with associated probabilities
+    the possible answers are in possible_indices with associated probabilities
     in weights.
 
-    It considers the pattern hash grid between the two lists of words, and uses
-    that to bucket together words from possible_words which would produce
+    It considers the pattern hash grid between the two sets of words, and uses
+    that to bucket together words from possible_indices which would produce
     the same pattern, adding together their corresponding probabilities.
+
+    The guesses are processed in chunks of rows, so that at most chunk_size
+    pairs of words are in memory at once.
     """
-    pattern_matrix = get_pattern_matrix(allowed_words, possible_words, game_name)
+    # Answers with zero weight do not contribute to the distributions, so
+    # their columns are not even gathered from the grid.
+    weights = np.asarray(weights)
+    nonzero = np.flatnonzero(weights)
+    if len(nonzero) < len(weights):
+        possible_indices = np.asarray(possible_indices)[nonzero]
+        weights = weights[nonzero]
+
+    n = len(allowed_indices)
+    rows_per_chunk = max(1, chunk_size // max(1, len(possible_indices)))
 
-    n = len(allowed_words)
     distributions = np.zeros((n, 3**5))
-    n_range = np.arange(n)
-    for j, prob in enumerate(weights):
-        distributions[n_range, pattern_matrix[:, j]] += prob
+    for start in range(0, n, rows_per_chunk):
+        pattern_matrix = get_pattern_matrix_from_indices(
+            allowed_indices[start : start + rows_per_chunk],
+            possible_indices,
+            game_name,
+        )
+        chunk = get_distributions_from_patterns(pattern_matrix, weights)
+        distributions[start : start + rows_per_chunk] = chunk
     return distributions
 
 
-def entropy_of_distributions(distributions):
-    axis = len(distributions.shape) - 1
-    return entropy(distributions, base=2, axis=axis)
+def get_pattern_distributions(allowed_words, possible_words, weights, game_name):
+    return get_pattern_distributions_from_indices(
+        get_word_indices(allowed_words, game_name),
+        get_word_indices(possible_words, game_name),
+        weights,
+        game_name,
+    )
+
+
+def get_entropy_buffer(name, shape, dtype):
+    key = (name, np.dtype(dtype).str)
+    size = int(np.prod(shape))
+    if key not in ENTROPY_BUFFERS or ENTROPY_BUFFERS[key].size < size:
+        ENTROPY_BUFFERS[key] = np.empty(size, dtype=dtype)
+    return ENTROPY_BUFFERS[key][:size].reshape(shape)
 
 
-def get_entropies(allowed_words, possible_words, weights, game_name):
+def entropy_of_distributions(
+    distributions,
+    dtype=np.float64,
+    block_size=ENTROPY_BLOCK_SIZE,
+):
+    """
+    Returns the entropy, in bits, of each distribution along the last axis,
+    which need not be normalized. The arithmetic is the one of
+    scipy.stats.entropy, i.e. the distributions are normalized, -p ln p is
+    summed, then divided by ln 2, so that the entropies are identical to the
+    last bit, and ties between guesses are broken the same way. Like
+    scipy.stats.entropy, distributions with no weight get nan.
+
+    The distributions are processed in blocks, in buffers which are reused
+    across calls, and in the given dtype, e.g. np.float32 to halve the
+    memory traffic at the cost of precision.
+    """
+    distributions = np.asarray(distributions)
+    shape = distributions.shape
+    distributions = distributions.reshape((-1, shape[-1]))
+    n = len(distributions)
+    result = np.empty(n, dtype=dtype)
+    for start in range(0, n, block_size):
+        block = distributions[start : start + block_size]
+        probs = get_entropy_buffer("probs", block.shape, dtype)
+        np.copyto(probs, block, casting="same_kind")
+        totals = probs.sum(axis=1, keepdims=True)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            np.divide(probs, totals, out=probs)
+        entr(probs, out=probs)
+        result[start : start + block_size] = probs.sum(axis=1) / math.log(2)
+    return result.reshape(shape[:-1])[()]
+
+
+def get_bucket_entropies(
+    pattern_matrix,
+    bucket_ids,
+    n_buckets,
+    weights,
+    chunk_size=DISTRIBUTION_CHUNK_SIZE,
+):
+    """
+    The columns of pattern_matrix are split into n_buckets buckets, given by
+    bucket_ids. For each row, and each bucket, this returns the entropy of
+    the distribution of patterns across the columns of that bucket, with
+    the weights of the columns normalized within the bucket. Every bucket
+    must have a positive weight.
+
+    Rather than building a (rows, buckets, 3^5) array of distributions, the
+    entries of each row are sorted by (bucket, pattern), and only the runs
+    of equal keys, i.e. the non-empty cells, are summed.
+    """
+    n, m = pattern_matrix.shape
+    weights = np.asarray(weights)
+    bucket_weights = np.bincount(bucket_ids, weights=weights, minlength=n_buckets)
+    key_offsets = (np.asarray(bucket_ids) * 3**5).astype(np.uint16)
+
+    entropies = np.empty((n, n_buckets))
+    rows_per_chunk = max(1, chunk_size // max(1, m))
+    for start in range(0, n, rows_per_chunk):
+        keys = pattern_matrix[start : start + rows_per_chunk] + key_offsets
+        order = np.argsort(keys, axis=1, kind="stable")
+        keys = np.take_along_axis(keys, order, axis=1)
+
+        # Flattened positions where a run of equal keys starts
+        is_start = np.ones(keys.shape, dtype=bool)
+        is_start[:, 1:] = keys[:, 1:] != keys[:, :-1]
+        starts = np.flatnonzero(is_start)
+        sums = np.add.reduceat(weights[order].ravel(), starts)
+
+        # With S the weights summed per pattern within a bucket of weight W,
+        # the entropy is log(W) - sum(S log S) / W
+        n_rows = len(keys)
+        cells = (starts // m) * n_buckets + keys.ravel()[starts] // 3**5
+        xlogx = np.bincount(
+            cells,
+            weights=sums * np.log2(sums),
+            minlength=n_rows * n_buckets,
+        ).reshape((n_rows, n_buckets))
+        entropies[start : start + n_rows] = (
+            np.log2(bucket_weights) - xlogx / bucket_weights
+        )
+    return entropies
+
+
+def get_entropies_from_indices(
+    allowed_indices,
+    possible_indices,
+    weights,
+    game_name,
+    dtype=np.float64,
+):
     if weights.sum() == 0:
-        return np.zeros(len(allowed_words))
-    distributions = get_pattern_distributions(
-        allowed_words,
-        possible_words,
+        return np.zeros(len(allowed_indices))
+    distributions = get_pattern_distributions_from_indices(
+        allowed_indices,
+        possible_indices,
+        weights,
+        game_name,
+    )
+    return entropy_of_distributions(distributions, dtype=dtype)
+
+
+def get_entropies(allowed_words, possible_words, weights, game_name):
+    return get_entropies_from_indices(
+        get_word_indices(allowed_words, game_name),
+        get_word_indices(possible_words, game_name),
+        weights,
+        game_name,
+    )
+
+
+def get_bucket_sizes_from_indices(allowed_indices, possible_indices, game_name):
+    """
+    Returns a (len(allowed_indices), 243) shape array representing the size of
+    word buckets associated with each guess in allowed_indices
+    """
+    weights = np.ones(len(possible_indices))
+    return get_pattern_distributions_from_indices(
+        allowed_indices,
+        possible_indices,
         weights,
         game_name,
     )
-    return entropy_of_distributions(distributions)
 
 
 def get_bucket_sizes(allowed_words, possible_words, game_name):
+    return get_bucket_sizes_from_indices(
+        get_word_indices(allowed_words, game_name),
+        get_word_indices(possible_words, game_name),
+        game_name,
+    )
+
+
+def get_bucket_counts_from_indices(allowed_indices, possible_indices, game_name):
     """
-    Returns a (len(allowed_words), 243) shape array representing the size of
-    word buckets associated with each guess in allowed_words
+    Returns the number of separate buckets that each guess in allowed_indices
+    would separate possible_indices into
     """
-    weights = np.ones(len(possible_words))
-    return get_pattern_distributions(allowed_words, possible_words, weights, game_name)
+    bucket_sizes = get_bucket_sizes_from_indices(
+        allowed_indices,
+        possible_indices,
+        game_name,
+    )
+    return (bucket_sizes > 0).sum(1)
 
 
 def get_bucket_counts(allowed_words, possible_words, game_name):
+    return get_bucket_counts_from_indices(
+        get_word_indices(allowed_words, game_name),
+        get_word_indices(possible_words, game_name),
+        game_name,
+    )
+
+
+def get_bucket_max_weights_from_indices(
+    allowed_indices,
+    possible_indices,
+    weights,
+    game_name,
+):
     """
-    Returns the number of separate buckets that each guess in allowed_words
-    would separate possible_words into
+    Returns a (len(allowed_indices), 243) shape array with the largest weight
+    among the words of possible_indices in each bucket of each guess
     """
-    bucket_sizes = get_bucket_sizes(allowed_words, possible_words, game_name)
-    return (bucket_sizes > 0).sum(1)
+    pattern_matrix = get_pattern_matrix_from_indices(
+        allowed_indices,
+        possible_indices,
+        game_name,
+    )
+    n = len(allowed_indices)
+    keys = np.arange(n)[:, np.newaxis] * 3**5 + pattern_matrix
+    max_weights = np.zeros(n * 3**5)
+    np.maximum.at(max_weights, keys.ravel(), np.tile(weights, n))
+    return max_weights.reshape(n, 3**5)
@@ -0,0 +1,308 @@
+import json
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+from tqdm import tqdm
+
+from src.file import get_exact_decision_tree_fname
+from src.pattern import (
+    ALL_GREEN,
+    MAX_TRIVIAL_CANDIDATES,
+    get_pattern_matrix_from_indices,
+    get_word_indices,
+    load_pattern_grid,
+)
+from src.prior import get_word_list
+
+# Exact solver, which finds the decision tree minimizing the total number of
+# guesses needed to find each of a set of equally likely answers. Game states
+# are sets of candidate answers, given as sorted arrays of positions in the
+# list of answers, and their costs are memoized by candidate set.
+
+# Number of candidates from which buckets are counted by marking the patterns
+# which occur, rather than by sorting the patterns of each guess
+SORT_THRESHOLD = 20
+
+# To store the patterns of the allowed guesses against the answers, and the
+# memoized game states, in each process
+EXACT_DATA: dict[str, Any] = {}
+
+
+def init_exact_solver(allowed_indices, answer_indices, game_name):
+    load_pattern_grid(game_name)
+    allowed_indices = np.asarray(allowed_indices)
+    answer_indices = np.asarray(answer_indices)
+    rows = np.full(len(get_word_list(game_name)), -1)
+    rows[allowed_indices] = np.arange(len(allowed_indices))
+    if (rows[answer_indices] < 0).any():
+        msg = "Every answer must be an allowed guess."
+        raise ValueError(msg)
+
+    EXACT_DATA["words"] = get_word_list(game_name)
+    EXACT_DATA["allowed_indices"] = allowed_indices
+    EXACT_DATA["answer_rows"] = rows[answer_indices]
+    # Patterns of each answer against each guess, so that the patterns of a
+    # set of candidates are contiguous rows
+    EXACT_DATA["patterns"] = np.ascontiguousarray(
+        get_pattern_matrix_from_indices(allowed_indices, answer_indices, game_name).T,
+    )
+    EXACT_DATA["memo"] = {}
+
+
+def get_lower_bounds(patterns):
+    """
+    Returns a lower bound on the total number of guesses needed to find each
+    answer of the rows of patterns, when starting with the guess of each
+    column, along with the number of buckets of each guess. At best, besides
+    the guess itself, one answer of each bucket is found with the next guess
+    and the others with the one after, so the bound is 3n - n_buckets, minus
+    one if the guess is an answer.
+    """
+    n, n_guesses = patterns.shape
+    if n < SORT_THRESHOLD:
+        sorted_patterns = np.sort(patterns, axis=0)
+        n_buckets = 1 + np.count_nonzero(np.diff(sorted_patterns, axis=0), axis=0)
+        is_answer = sorted_patterns[-1] == ALL_GREEN
+    else:
+        seen = np.zeros((3**5, n_guesses), dtype=bool)
+        seen[patterns, np.arange(n_guesses)] = True
+        n_buckets = np.count_nonzero(seen, axis=0)
+        is_answer = seen[ALL_GREEN]
+    return 3 * n - n_buckets - is_answer, n_buckets
+
+
+def split_candidates(candidates, guess):
+    """
+    Returns the (pattern, bucket) pairs into which guess, a row of the pattern
+    matrix, splits candidates. Buckets keep the order of candidates.
+    """
+    patterns = EXACT_DATA["patterns"][candidates, guess]
+    order = np.argsort(patterns, kind="stable")
+    patterns = patterns[order]
+    starts = np.flatnonzero(np.r_[True, patterns[1:] != patterns[:-1]])
+    return list(
+        zip(patterns[starts], np.split(candidates[order], starts[1:]), strict=True),
+    )
+
+
+def get_set_lower_bound(candidates):
+    """
+    Returns a lower bound on the minimum total number of guesses needed to
+    find each answer of candidates. Small sets get the bound of a guess which
+    would split them into single answers, and larger ones the best bound of
+    their guesses, which is memoized until the minimum itself is.
+    """
+    n = len(candidates)
+    memo = EXACT_DATA["memo"]
+    key = candidates.tobytes()
+    if key in memo:
+        return memo[key][0]
+    if n < SORT_THRESHOLD:
+        return 2 * n - 1
+    lower_bounds, n_buckets = get_lower_bounds(EXACT_DATA["patterns"][candidates])
+    memo[key] = (lower_bounds[n_buckets > 1].min(), None)
+    return memo[key][0]
+
+
+def evaluate_guess(candidates, guess, beta=math.inf):
+    """
+    Returns the total number of guesses needed to find each answer of
+    candidates, when starting with guess and playing optimally afterwards.
+    The search is cut off as soon as the total reaches beta, in which case
+    the returned value is only a lower bound, of at least beta.
+    """
+    buckets = [
+        bucket
+        for pattern, bucket in split_candidates(candidates, guess)
+        if pattern != ALL_GREEN
+    ]
+    # Larger buckets first, as they are the most likely to cut the search off
+    buckets.sort(key=len, reverse=True)
+    lower_bounds = [get_set_lower_bound(bucket) for bucket in buckets]
+    total = len(candidates) + sum(lower_bounds)
+    for bucket, lower_bound in zip(buckets, lower_bounds, strict=True):
+        if total >= beta:
+            break
+        value, _ = get_min_total_guesses(bucket, beta - (total - lower_bound))
+        total += value - lower_bound
+    return total
+
+
+def get_min_total_guesses(candidates, beta=math.inf):
+    """
+    Returns the minimum total number of guesses needed to find each answer of
+    candidates, and the row of the best guess. If that minimum is not below
+    beta, the search is cut off, and the returned value is only a lower bound,
+    of at least beta, with no guess.
+    """
+    n = len(candidates)
+    if n <= MAX_TRIVIAL_CANDIDATES:
+        # Guess the first answer, then the second one
+        return 2 * n - 1, EXACT_DATA["answer_rows"][candidates[0]]
+
+    memo = EXACT_DATA["memo"]
+    key = candidates.tobytes()
+    value, guess = memo.get(key, (0, None))
+    if guess is not None or value >= beta:
+        return value, guess
+
+    patterns = EXACT_DATA["patterns"][candidates]
+    lower_bounds, n_buckets = get_lower_bounds(patterns)
+    # Guesses which do not split the candidates make no progress
+    guesses = np.flatnonzero(n_buckets > 1)
+    guesses = guesses[np.argsort(lower_bounds[guesses], kind="stable")]
+
+    best_value, best_guess = beta, None
+    for guess in guesses:
+        if lower_bounds[guess] >= best_value:
+            break
+        value = evaluate_guess(candidates, guess, best_value)
+        if value < best_value:
+            best_value, best_guess = value, guess
+
+    # Without a guess below beta, beta is a lower bound of the minimum
+    memo[key] = (best_value, best_guess)
+    return best_value, best_guess
+
+
+def get_decision_tree(candidates):
+    """
+    Returns the optimal decision tree for candidates, whose nodes hold the
+    guess, and a child node for each pattern other than all greens.
+    """
+    _, guess = get_min_total_guesses(candidates)
+    children = {
+        int(pattern): get_decision_tree(bucket)
+        for pattern, bucket in split_candidates(candidates, guess)
+        if pattern != ALL_GREEN
+    }
+    word = EXACT_DATA["words"][EXACT_DATA["allowed_indices"][guess]]
+    return {"guess": word, "children": children}
+
+
+def solve_bucket(bucket, beta):
+    value, _ = get_min_total_guesses(bucket, beta)
+    tree = get_decision_tree(bucket) if value < beta else None
+    return value, tree
+
+
+def solve_exact(
+    game_name,
+    answer_indices=None,
+    allowed_indices=None,
+    first_guess=None,
+    n_workers=1,
+    display_progress=True,
+):
+    """
+    Finds the decision tree minimizing the total number of guesses needed to
+    find each answer of answer_indices, by default the short word list, with
+    guesses from allowed_indices, by default the full word list. Returns that
+    total, and the tree, in the format of the decision trees of simulate_games.
+
+    Guesses are tried in order of their lower bounds, and skipped once their
+    bound is no better than the best total found so far. The same bounds cut
+    off the search of each bucket, and the minimum of every candidate set is
+    memoized. With n_workers processes, the buckets of each first guess are
+    solved in parallel, each worker keeping its own memo.
+    """
+    all_words = get_word_list(game_name)
+    if answer_indices is None:
+        answer_indices = get_word_indices(
+            get_word_list(game_name, short=True),
+            game_name,
+        )
+    if allowed_indices is None:
+        allowed_indices = np.arange(len(all_words))
+    init_exact_solver(allowed_indices, answer_indices, game_name)
+    candidates = np.arange(len(answer_indices))
+
+    lower_bounds, n_buckets = get_lower_bounds(EXACT_DATA["patterns"])
+    if first_guess is not None:
+        first_guess_index = get_word_indices([first_guess], game_name)[0]
+        guesses = np.flatnonzero(EXACT_DATA["allowed_indices"] == first_guess_index)
+    else:
+        guesses = np.flatnonzero(n_buckets > 1)
+        guesses = guesses[np.argsort(lower_bounds[guesses], kind="stable")]
+
+    executor = None
+    if n_workers > 1:
+        # Workers are spawned rather than forked, since forking a process whose
+        # numba thread pool is running deadlocks
+        executor = ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_exact_solver,
+            initargs=(allowed_indices, answer_indices, game_name),
+        )
+    best_value, best_guess, best_children = math.inf, None, None
+    for guess in tqdm(guesses, leave=False, disable=not display_progress):
+        if lower_bounds[guess] >= best_value:
+            break
+        if executor is None:
+            value = evaluate_guess(candidates, guess, best_value)
+            if value < best_value:
+                best_value, best_guess = value, guess
+            continue
+
+        # Each bucket is bounded by the best total, minus the lower bounds of
+        # the other buckets
+        buckets = {
+            int(pattern): bucket
+            for pattern, bucket in split_candidates(candidates, guess)
+            if pattern != ALL_GREEN
+        }
+        slack = best_value - lower_bounds[guess]
+        futures = {
+            pattern: executor.submit(
+                solve_bucket,
+                bucket,
+                slack + 2 * len(bucket) - 1,
+            )
+            for pattern, bucket in buckets.items()
+        }
+        results = {pattern: future.result() for pattern, future in futures.items()}
+        value = len(candidates) + sum(value for value, _ in results.values())
+        if value < best_value:
+            best_value, best_guess = value, guess
+            best_children = {pattern: tree for pattern, (_, tree) in results.items()}
+    if executor is not None:
+        executor.shutdown()
+
+    if best_children is None:
+        best_children = {
+            int(pattern): get_decision_tree(bucket)
+            for pattern, bucket in split_candidates(candidates, best_guess)
+            if pattern != ALL_GREEN
+        }
+    word = all_words[EXACT_DATA["allowed_indices"][best_guess]]
+    decision_tree = {"guess": word, "children": best_children}
+    EXACT_DATA.clear()
+    return int(best_value), decision_tree
+
+
+def build_exact_decision_tree(game_name, first_guess=None, n_workers=1):
+    """
+    Solves the game exactly, for the answers of the short word list, and saves
+    the total number of guesses, the average score and the decision tree.
+    """
+    answers = get_word_list(game_name, short=True)
+    total_guesses, decision_tree = solve_exact(
+        game_name,
+        first_guess=first_guess,
+        n_workers=n_workers,
+    )
+    result = {
+        "total_guesses": total_guesses,
+        "average_score": total_guesses / len(answers),
+        "decision_tree": decision_tree,
+    }
+    fname = Path(get_exact_decision_tree_fname(game_name))
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    with fname.open("w", encoding="utf8") as fp:
+        json.dump(result, fp)
+    return result
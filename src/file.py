@@ -6,7 +6,11 @@ LONG_WORD_LIST_FILE = "allowed_words.txt"
 WORD_FREQ_FILE = "wordle_words_freq_full.txt"
 WORD_FREQ_MAP_FILE = "freq_map.json"
 PATTERN_MATRIX_FILE = "pattern_matrix.npy"
+PATTERN_MATRIX_METADATA_FILE = "pattern_matrix.json"
 SIMULATION_DIR = "simulation_results"
+OPENING_BOOK_DIR = "opening_book"
+DECISION_CACHE_FILE = "decision_cache.sqlite"
+EXACT_DECISION_TREE_FILE = "exact_decision_tree.json"
 
 
 def get_data_dir(game_name):
@@ -25,6 +29,15 @@ def get_long_word_list_fname(game_name):
     return get_data_fname(game_name, LONG_WORD_LIST_FILE)
 
 
+def get_word_array_fname(word_list_fname):
+    """
+    Returns the name of the binary version of a word list, which stores the
+    letters of the words as a uint8 array, along with the size and the
+    modification time of the word list it was generated from.
+    """
+    return Path(word_list_fname).with_suffix(".npz")
+
+
 def get_word_freq_fname(game_name):
     return get_data_fname(game_name, WORD_FREQ_FILE)
 
@@ -37,5 +50,21 @@ def get_pattern_matrix_fname(game_name):
     return get_data_fname(game_name, PATTERN_MATRIX_FILE)
 
 
+def get_pattern_matrix_metadata_fname(game_name):
+    return get_data_fname(game_name, PATTERN_MATRIX_METADATA_FILE)
+
+
 def get_simulation_results_folder(game_name):
     return get_data_fname(game_name, SIMULATION_DIR)
+
+
+def get_opening_book_fname(game_name, key):
+    return get_data_fname(game_name, OPENING_BOOK_DIR) / f"{key}.json"
+
+
+def get_decision_cache_fname(game_name):
+    return Path(get_simulation_results_folder(game_name)) / DECISION_CACHE_FILE
+
+
+def get_exact_decision_tree_fname(game_name):
+    return Path(get_simulation_results_folder(game_name)) / EXACT_DECISION_TREE_FILE
@@ -1,51 +1,289 @@
-import itertools
+import hashlib
+import io
+import json
 import logging
 from pathlib import Path
 from typing import Any
 
 import numpy as np
 
-from src.block import generate_full_pattern_matrix_in_blocks
-from src.file import get_pattern_matrix_fname
+from src.block import (
+    MEMORY_BUDGET,
+    generate_full_pattern_matrix_in_parallel,
+    generate_new_pattern_matrix_tiles,
+)
+from src.file import get_pattern_matrix_fname, get_pattern_matrix_metadata_fname
 from src.pattern_utils import EXACT, MISPLACED, MISS, generate_pattern_matrix
-from src.prior import get_word_list
+from src.prior import append_to_word_list, get_corpus, get_letter_array
 
-# To store the large grid of patterns at run time
+# To store the large grid of patterns at run time. The grid is memory-mapped
+# rather than read into memory, so that its pages are loaded lazily and shared
+# through the OS page cache between processes working on the same game.
 PATTERN_GRID_DATA: dict[str, Any] = {}
 
+# Version of the encoding of patterns as integers, to be bumped whenever it
+# changes, so that the grids saved with another encoding are regenerated
+PATTERN_ENCODING_VERSION = 1
+
+# Pattern of a guess which is the answer, i.e. five greens
+ALL_GREEN = 3**5 - 1
+
+# Number of candidate answers up to which the optimal play is known: guess
+# one of them, the most likely one if they are weighted, then the other one
+MAX_TRIVIAL_CANDIDATES = 2
+
 
 # Generating color patterns between strings, etc.
 
 
-def generate_full_pattern_matrix(game_name):
-    words = get_word_list(game_name)
-    pattern_matrix = generate_full_pattern_matrix_in_blocks(words)
-    # Save to file
-    np.save(get_pattern_matrix_fname(game_name), pattern_matrix)
-    return pattern_matrix
+def generate_full_pattern_matrix(
+    game_name,
+    n_workers=1,
+    memory_budget=MEMORY_BUDGET,
+):
+    # The letters of the words, read into memory once rather than encoded
+    # again for each tile
+    words = np.array(get_letter_array(game_name))
+    fname = Path(get_pattern_matrix_fname(game_name))
+    # Write the tiles directly into a .npy file, which is only moved to its
+    # final location once complete, so that an interrupted run leaves no
+    # truncated grid behind.
+    partial_fname = fname.with_suffix(".partial")
+    generate_full_pattern_matrix_in_parallel(
+        words,
+        partial_fname,
+        n_workers=n_workers,
+        memory_budget=memory_budget,
+    )
+    partial_fname.replace(fname)
+    save_pattern_matrix_metadata(game_name, words)
+    return np.load(fname, mmap_mode="r")
 
 
-def get_pattern_matrix(words1, words2, game_name):
+def extend_pattern_matrix(game_name, n_old, memory_budget=MEMORY_BUDGET):
+    """
+    Extends the saved pattern grid of the first n_old words of the word list
+    to the full word list, in place, computing only the rows and columns of
+    the words appended since.
+
+    The file is enlarged, and the old rows are moved to their new offsets
+    starting from the last one, whose offset grows the most, so that no row
+    is overwritten before being moved, and no second copy of the grid is
+    written to disk.
+    """
+    words = np.array(get_letter_array(game_name))
+    n = len(words)
+    fname = Path(get_pattern_matrix_fname(game_name))
+    version, _, offset = read_grid_header(fname)
+    header = get_grid_header(version, (n, n))
+    if len(header) != offset:
+        # The header of the larger grid does not fit before the old grid
+        return generate_full_pattern_matrix(game_name, memory_budget=memory_budget)
+
+    # The header keeps the old shape until the grid is complete, and without
+    # metadata, an interrupted extension leaves a grid of the wrong shape,
+    # which is regenerated
+    Path(get_pattern_matrix_metadata_fname(game_name)).unlink(missing_ok=True)
+    with fname.open("r+b") as fp:
+        fp.truncate(offset + n * n)
+    flat_grid = np.memmap(fname, dtype=np.uint8, mode="r+", offset=offset, shape=n * n)
+    rows_per_chunk = max(1, memory_budget // n)
+    for start in reversed(range(0, n_old, rows_per_chunk)):
+        stop = min(start + rows_per_chunk, n_old)
+        old_rows = np.array(flat_grid[start * n_old : stop * n_old])
+        new_rows = flat_grid[start * n : stop * n].reshape(-1, n)
+        new_rows[:, :n_old] = old_rows.reshape(-1, n_old)
+    grid = flat_grid.reshape(n, n)
+    generate_new_pattern_matrix_tiles(words, n_old, grid, memory_budget)
+    flat_grid.flush()
+    del grid, flat_grid
+
+    with fname.open("r+b") as fp:
+        fp.write(header)
+    save_pattern_matrix_metadata(game_name, words)
+    return np.load(fname, mmap_mode="r")
+
+
+def read_grid_header(fname):
+    """
+    Returns the format version of the .npy file fname, the shape of its grid,
+    and the length of its header, i.e. the offset of the grid in the file.
+    """
+    with Path(fname).open("rb") as fp:
+        version = np.lib.format.read_magic(fp)
+        if version == (1, 0):
+            shape, _, _ = np.lib.format.read_array_header_1_0(fp)
+        else:
+            shape, _, _ = np.lib.format.read_array_header_2_0(fp)
+        return version, shape, fp.tell()
+
+
+def get_grid_header(version, shape):
+    header = {
+        "descr": np.lib.format.dtype_to_descr(np.dtype(np.uint8)),
+        "fortran_order": False,
+        "shape": shape,
+    }
+    buffer = io.BytesIO()
+    if version == (1, 0):
+        np.lib.format.write_array_header_1_0(buffer, header)
+    else:
+        np.lib.format.write_array_header_2_0(buffer, header)
+    return buffer.getvalue()
+
+
+def add_words(game_name, new_words, memory_budget=MEMORY_BUDGET):
+    """
+    Appends new_words to the word list of the game, and extends its saved
+    pattern grid with their rows and columns, so that adding k words to a
+    list of n costs O(n * k) patterns rather than O(n^2). Returns the words
+    which were added, i.e. the ones which were not already in the list.
+    """
+    status, _ = get_pattern_matrix_status(game_name)
+    added_words = append_to_word_list(game_name, new_words)
+    if added_words and status in ("valid", "appended"):
+        _, n_old = get_pattern_matrix_status(game_name)
+        extend_pattern_matrix(game_name, n_old, memory_budget=memory_budget)
+    # The grid and the word list are loaded again with the new words
+    PATTERN_GRID_DATA.clear()
+    return added_words
+
+
+# Metadata of the saved grid, to check that it matches the word list
+
+
+def get_word_list_hash(letter_array):
+    return hashlib.sha256(np.ascontiguousarray(letter_array).tobytes()).hexdigest()
+
+
+def get_pattern_matrix_metadata(letter_array):
+    n_words, word_length = letter_array.shape
+    return {
+        "encoding_version": PATTERN_ENCODING_VERSION,
+        "word_length": word_length,
+        "n_words": n_words,
+        "word_list_hash": get_word_list_hash(letter_array),
+    }
+
+
+def save_pattern_matrix_metadata(game_name, letter_array):
+    with Path(get_pattern_matrix_metadata_fname(game_name)).open(
+        "w",
+        encoding="utf8",
+    ) as fp:
+        json.dump(get_pattern_matrix_metadata(letter_array), fp)
+
+
+def get_pattern_matrix_status(game_name):
+    """
+    Compares the saved pattern grid with the word list of the game, without
+    reading the grid itself. Returns the status of the grid, which is either
+    "valid", "missing", "appended" if words were only appended to the list
+    since the grid was saved, or "stale" if it was generated for another
+    list or encoding, along with the number of words of the saved grid.
+    """
+    fname = Path(get_pattern_matrix_fname(game_name))
+    if not fname.exists():
+        return "missing", 0
+    letter_array = get_letter_array(game_name)
+    metadata_fname = Path(get_pattern_matrix_metadata_fname(game_name))
+    if not metadata_fname.exists():
+        return get_unversioned_pattern_matrix_status(game_name)
+    with metadata_fname.open(encoding="utf8") as fp:
+        metadata = json.load(fp)
+    n_old = metadata["n_words"]
+    current = get_pattern_matrix_metadata(letter_array[:n_old])
+    if metadata != current:
+        return "stale", n_old
+    if n_old < len(letter_array):
+        return "appended", n_old
+    return "valid", n_old
+
+
+def get_unversioned_pattern_matrix_status(game_name):
+    """
+    Checks a grid saved without metadata, from its shape and from the row of
+    one of the words, and saves its metadata if it matches the word list.
+    """
+    letter_array = get_letter_array(game_name)
+    n = len(letter_array)
+    grid = np.load(get_pattern_matrix_fname(game_name), mmap_mode="r")
+    if grid.shape != (n, n):
+        return "stale", len(grid)
+    i = n // 2
+    if not np.array_equal(
+        grid[i],
+        generate_pattern_matrix(letter_array[i : i + 1], letter_array)[0],
+    ):
+        return "stale", n
+    save_pattern_matrix_metadata(game_name, letter_array)
+    return "valid", n
+
+
+def load_pattern_grid(game_name, n_workers=1):
+    """
+    Loads the pattern grid of the game, generating it first with n_workers
+    processes if it has not been saved to file yet, or if it was saved for
+    another word list. When words were only appended to the list, just
+    their rows and columns are added to the saved grid.
+    """
+    if PATTERN_GRID_DATA:
+        return
     pattern_matrix_fname = get_pattern_matrix_fname(game_name)
-    if not PATTERN_GRID_DATA:
-        if not Path(pattern_matrix_fname).exists():
-            logging.info(
-                "Generating pattern matrix. This takes a minute, but\nthe result will be saved to file so that it only\nneeds to be computed once.",
+    status, n_old = get_pattern_matrix_status(game_name)
+    if status == "appended":
+        logging.info("Adding the appended words to the pattern matrix.")
+        extend_pattern_matrix(game_name, n_old)
+    elif status != "valid":
+        if status == "stale":
+            logging.warning(
+                "The saved pattern matrix does not match the word list, and is regenerated.",
             )
-            generate_full_pattern_matrix(game_name)
-        PATTERN_GRID_DATA["grid"] = np.load(pattern_matrix_fname)
-        PATTERN_GRID_DATA["words_to_index"] = dict(
-            zip(get_word_list(game_name), itertools.count(), strict=False),
+        logging.info(
+            "Generating pattern matrix. This takes a minute, but\nthe result will be saved to file so that it only\nneeds to be computed once.",
         )
+        generate_full_pattern_matrix(game_name, n_workers=n_workers)
+    corpus = get_corpus(game_name)
+    PATTERN_GRID_DATA["grid"] = np.load(pattern_matrix_fname, mmap_mode="r")
+    PATTERN_GRID_DATA["words"] = corpus["words"]
+    PATTERN_GRID_DATA["words_to_index"] = corpus["words_to_index"]
 
-    full_grid = PATTERN_GRID_DATA["grid"]
+
+# Conversions between words and their index in the word list of the game,
+# which is also the index of their row and column in the pattern grid
+
+
+def get_word_indices(words, game_name):
+    load_pattern_grid(game_name)
     words_to_index = PATTERN_GRID_DATA["words_to_index"]
+    return np.array([words_to_index[w] for w in words], dtype=int)
+
 
-    indices1 = [words_to_index[w] for w in words1]
-    indices2 = [words_to_index[w] for w in words2]
+def get_indexed_words(indices, game_name):
+    load_pattern_grid(game_name)
+    words = PATTERN_GRID_DATA["words"]
+    return [words[i] for i in indices]
+
+
+def get_pattern_matrix_from_indices(indices1, indices2, game_name):
+    load_pattern_grid(game_name)
+    full_grid = PATTERN_GRID_DATA["grid"]
     return full_grid[np.ix_(indices1, indices2)]
 
 
+def get_pattern_matrix(words1, words2, game_name):
+    return get_pattern_matrix_from_indices(
+        get_word_indices(words1, game_name),
+        get_word_indices(words2, game_name),
+        game_name,
+    )
+
+
+def get_pattern_from_indices(guess_index, answer_index, game_name):
+    load_pattern_grid(game_name)
+    return PATTERN_GRID_DATA["grid"][guess_index, answer_index]
+
+
 def get_pattern(guess, answer, game_name):
     if PATTERN_GRID_DATA:
         saved_words = PATTERN_GRID_DATA["words_to_index"]
@@ -72,22 +310,54 @@ def patterns_to_string(patterns):
     return "\n".join(map(pattern_to_string, patterns))
 
 
+def get_possible_indices(guess_index, pattern, possible_indices, game_name):
+    """
+    Filters possible_indices down to the words which would produce the given
+    pattern with the guess, reading a single row of the pattern grid.
+    """
+    load_pattern_grid(game_name)
+    row = PATTERN_GRID_DATA["grid"][guess_index]
+    possible_indices = np.asarray(possible_indices)
+    result = possible_indices[row[possible_indices] == pattern]
+    logging.debug(
+        "Guess: %s, Pattern: %s, Words remaining: %d / %d",
+        guess_index,
+        pattern,
+        len(result),
+        len(possible_indices),
+    )
+    return result
+
+
+def get_possible_mask(guess_index, pattern, game_name):
+    """
+    Returns a boolean mask over the word list of the game, which is true for
+    the words which would produce the given pattern with the guess.
+    """
+    load_pattern_grid(game_name)
+    return PATTERN_GRID_DATA["grid"][guess_index] == pattern
+
+
 def get_possible_words(guess, pattern, word_list, game_name):
-    # Get all patterns between the guess and the word_list
-    all_patterns = get_pattern_matrix([guess], word_list, game_name).flatten()
-
-    # Filter out words that match the given pattern
-    possible_words = list(np.array(word_list)[all_patterns == pattern])
-
-    # Debugging: print detailed info
-    print(f"Guess: {guess}, Pattern: {pattern}")
-    print(f"Initial word list size: {len(word_list)}")
-    print(f"Words remaining after filtering: {len(possible_words)}")
-    
-    if not possible_words:
-        print("No possible words remain after filtering.")
-    
-    return possible_words
+    possible_indices = get_possible_indices(
+        get_word_indices([guess], game_name)[0],
+        pattern,
+        get_word_indices(word_list, game_name),
+        game_name,
+    )
+    return get_indexed_words(possible_indices, game_name)
+
+
+def get_index_buckets(guess_index, possible_indices, game_name):
+    """
+    Splits possible_indices into 3^5 arrays, according to the pattern
+    which each of them would produce with the guess.
+    """
+    load_pattern_grid(game_name)
+    hashes = PATTERN_GRID_DATA["grid"][guess_index, possible_indices]
+    order = np.argsort(hashes, kind="stable")
+    splits = np.searchsorted(hashes[order], np.arange(1, 3**5))
+    return np.split(np.asarray(possible_indices)[order], splits)
 
 
 def get_word_buckets(guess, possible_words, game_name):
@@ -1,17 +1,193 @@
 import itertools
+from typing import Any
 
 import numpy as np
 
+try:
+    import numba
+    from numba import prange
+except ImportError:
+    numba = None
+    prange = range
+
 MISS = np.uint8(0)
 MISPLACED = np.uint8(1)
 EXACT = np.uint8(2)
 
+PATTERN_BACKENDS = ["numpy", "numba"]
+
+# To store the backend used to compute patterns
+PATTERN_BACKEND: dict[str, Any] = {"name": "numba" if numba is not None else "numpy"}
+
 
 def words_to_int_arrays(words):
+    """
+    Returns the letters of words as a (n_words, n_letters) uint8 array. Words
+    which are already encoded as such an array, e.g. the word arrays of the
+    corpus, are returned as is.
+    """
+    if isinstance(words, np.ndarray) and words.dtype == np.uint8:
+        return words
     return np.array([[ord(c) for c in w] for w in words], dtype=np.uint8)
 
 
-def generate_pattern_matrix(words1, words2):
+def get_letter_masks(word_arr):
+    """
+    Encodes each word as per-letter position bitmasks: letter_masks[c, a]
+    has its i-th bit set when the i-th letter of the a-th word is chr(c).
+    """
+    nw, nl = word_arr.shape
+    letter_masks = np.zeros((256, nw), dtype=np.min_scalar_type(2**nl - 1))
+    for i in range(nl):
+        letter_masks[word_arr[:, i], np.arange(nw)] |= 1 << i
+    return letter_masks
+
+
+def get_pattern_backend():
+    return PATTERN_BACKEND["name"]
+
+
+def set_pattern_threads(n_threads):
+    """
+    Sets the number of threads used by the numba backend in this process,
+    e.g. to a single one in each worker of a pool which spans the cores.
+    """
+    if numba is not None:
+        numba.set_num_threads(n_threads)
+
+
+def set_pattern_backend(backend=None):
+    """
+    Selects the backend used by generate_pattern_matrix. By default, the
+    compiled numba backend is used if numba is installed.
+    """
+    if backend is None:
+        backend = "numba" if numba is not None else "numpy"
+    if backend not in PATTERN_BACKENDS:
+        msg = f"Unknown pattern backend: {backend}"
+        raise ValueError(msg)
+    if backend == "numba" and numba is None:
+        msg = "The numba backend requires numba to be installed."
+        raise ImportError(msg)
+    PATTERN_BACKEND["name"] = backend
+
+
+def generate_pattern_matrix(words1, words2, backend=None):
+    """
+    A pattern for two words represents the wordle-similarity
+    pattern (grey -> 0, yellow -> 1, green -> 2) but as an integer
+    between 0 and 3^5. Reading this integer in ternary gives the
+    associated pattern.
+
+    This function computes the pairwise patterns between two lists
+    of words, returning the result as a grid of hash values. Since
+    this can be time-consuming, the result is saved to file so that
+    this only needs to be evaluated once, and all remaining pattern
+    matching is a lookup.
+
+    The words are either lists of strings, or uint8 arrays of letters. The
+    backend, either "numpy" or "numba", defaults to the one chosen with
+    set_pattern_backend. Both give the same result.
+    """
+    if backend is None:
+        backend = get_pattern_backend()
+
+    # Convert word lists to integer arrays
+    word_arr1, word_arr2 = map(words_to_int_arrays, (words1, words2))
+
+    if backend == "numba":
+        return generate_pattern_matrix_with_numba(word_arr1, word_arr2)
+    return generate_pattern_matrix_with_bitmasks(word_arr1, word_arr2)
+
+
+def generate_pattern_matrix_with_bitmasks(word_arr1, word_arr2):
+    """
+    Computes the pattern grid between two integer arrays of words with NumPy.
+
+    Rather than comparing all pairs of letters, it encodes the positions
+    of each letter in a word as a bitmask, so that each pair of words
+    only requires a few integer operations per letter.
+    """
+
+    # Number of letters/words
+    nw1, nl = word_arr1.shape
+
+    # popcount[m] is the number of bits set in the bitmask m
+    popcount = np.array([m.bit_count() for m in range(2**nl)], dtype=np.uint8)
+
+    # green[a, b] has its i-th bit set when words1[a][i] == words2[b][i]
+    green = np.equal.outer(word_arr1[:, 0], word_arr2[:, 0]).view(np.uint8)
+    for i in range(1, nl):
+        green |= np.equal.outer(word_arr1[:, i], word_arr2[:, i]).view(np.uint8) << i
+    not_green = ~green & (2**nl - 1)
+
+    guess_masks = get_letter_masks(word_arr1)
+    answer_masks = get_letter_masks(word_arr2)
+
+    full_pattern_matrix = np.zeros(green.shape, dtype=np.uint8)
+    for i in range(nl):
+        letters = word_arr1[:, i]
+        # Number of occurrences of the i-th guess letter in the answer
+        # which are not already covered by the green pass
+        available = popcount[answer_masks[letters] & not_green]
+        # Number of earlier occurrences of that letter in the guess, which
+        # are not green, and hence take precedence for the yellow pass
+        earlier = guess_masks[letters, np.arange(nw1)] & (2**i - 1)
+        claimed = popcount[earlier[:, np.newaxis] & not_green]
+
+        is_green = (green >> i) & 1
+        is_misplaced = (available > claimed) & (is_green == 0)
+        full_pattern_matrix += is_green * (EXACT * 3**i)
+        full_pattern_matrix += is_misplaced * (MISPLACED * 3**i)
+
+    return full_pattern_matrix
+
+
+def compute_pattern_grid(word_arr1, word_arr2):
+    """
+    Computes the pattern grid between two integer arrays of words with a
+    plain loop over pairs of words, parallelized over guesses once compiled
+    by numba. For each pair, the answer letters consumed by the green and
+    yellow passes are tracked in a bitmask, so that no intermediate array
+    is allocated.
+    """
+    nw1, nl = word_arr1.shape
+    nw2 = word_arr2.shape[0]
+    full_pattern_matrix = np.empty((nw1, nw2), dtype=np.uint8)
+    for a in prange(nw1):
+        for b in range(nw2):
+            # Green pass
+            used = 0
+            for i in range(nl):
+                if word_arr1[a, i] == word_arr2[b, i]:
+                    used |= 1 << i
+            # Yellow pass, matching each guess letter with the first
+            # answer letter which is not covered yet
+            pattern = 0
+            power = 1
+            for i in range(nl):
+                if word_arr1[a, i] == word_arr2[b, i]:
+                    pattern += EXACT * power
+                else:
+                    for j in range(nl):
+                        if not (used >> j) & 1 and word_arr1[a, i] == word_arr2[b, j]:
+                            used |= 1 << j
+                            pattern += MISPLACED * power
+                            break
+                power *= 3
+            full_pattern_matrix[a, b] = pattern
+    return full_pattern_matrix
+
+
+if numba is not None:
+    generate_pattern_matrix_with_numba = numba.njit(parallel=True, cache=True)(
+        compute_pattern_grid,
+    )
+else:
+    generate_pattern_matrix_with_numba = None
+
+
+def generate_pattern_matrix_with_equality_grid(words1, words2):
     """
     A pattern for two words represents the wordle-similarity
     pattern (grey -> 0, yellow -> 1, green -> 2) but as an integer
@@ -1,5 +1,8 @@
+import itertools
 import json
+import logging
 from pathlib import Path
+from typing import Any
 
 import numpy as np
 from scipy.special import expit as sigmoid
@@ -7,25 +10,148 @@ from scipy.special import expit as sigmoid
 from src.file import (
     get_long_word_list_fname,
     get_short_word_list_fname,
+    get_word_array_fname,
     get_word_freq_fname,
     get_word_freq_map_fname,
 )
 
+# To store the word lists of each game, along with the index of each word and
+# the priors computed from them. They are read from file once, and read again
+# only when the files change.
+CORPUS_DATA: dict[str, Any] = {}
+
 # Reading from files
 
 
-def get_word_list(game_name, short=False):
-    result = []
-    file = (
-        get_short_word_list_fname(game_name)
-        if short
-        else get_long_word_list_fname(game_name)
-    )
+def read_word_list(file):
     with Path(file).open(encoding="utf8") as fp:
-        result.extend([word.strip() for word in fp])
-    print(f"Loaded {len(result)} words from {file}")  # Debugging line
+        result = [word.strip() for word in fp]
+    logging.debug("Loaded %d words from %s", len(result), file)
     return result
 
+
+def words_to_letter_array(words):
+    """
+    Returns the letters of words, which must all have the same length, as a
+    (n_words, n_letters) uint8 array.
+    """
+    word_length = len(words[0])
+    if any(len(word) != word_length for word in words):
+        msg = "All the words of a word list must have the same length."
+        raise ValueError(msg)
+    encoded = np.array([word.encode("ascii") for word in words])
+    return encoded.view(np.uint8).reshape(len(words), word_length)
+
+
+def letter_array_to_words(letter_array):
+    n_words, word_length = letter_array.shape
+    encoded = np.ascontiguousarray(letter_array).view(f"S{word_length}")
+    return encoded.reshape(n_words).astype(f"U{word_length}").tolist()
+
+
+def get_file_stamp(file):
+    """
+    Returns the size and the modification time of file, which change along
+    with its content even when it is rewritten within the same clock tick,
+    as long as the number of words changes.
+    """
+    stat = Path(file).stat()
+    return stat.st_size, stat.st_mtime_ns
+
+
+def read_word_array(file):
+    """
+    Returns the binary version of the word list file, i.e. the letters of its
+    words as a read-only (n_words, n_letters) uint8 array. It is generated
+    from the text file if missing, or if the stamp of the text file which it
+    was generated from differs from the current one.
+    """
+    fname = get_word_array_fname(file)
+    stamp = get_file_stamp(file)
+    if fname.exists():
+        with np.load(fname) as data:
+            if tuple(data["source_stamp"].tolist()) == stamp:
+                letter_array = data["letters"]
+                letter_array.flags.writeable = False
+                return letter_array
+
+    letter_array = words_to_letter_array(read_word_list(file))
+    # Write to a temporary file first, so that an interrupted write never
+    # leaves a truncated array behind
+    partial_fname = fname.with_suffix(".partial.npz")
+    np.savez(partial_fname, letters=letter_array, source_stamp=np.array(stamp))
+    partial_fname.replace(fname)
+    logging.info("Saved the letters of %d words to %s", len(letter_array), fname)
+    letter_array.flags.writeable = False
+    return letter_array
+
+
+def get_corpus(game_name):
+    """
+    Returns the corpus of the game, i.e. a dict with its full and short word
+    lists, their letters as uint8 arrays, the index of each word in the full
+    list, and a cache of priors. It is loaded once, from the binary version
+    of the word lists, and reloaded if the size or the modification time of
+    either word list has changed.
+    """
+    fnames = (get_long_word_list_fname(game_name), get_short_word_list_fname(game_name))
+    stamps = tuple(get_file_stamp(fname) for fname in fnames)
+    corpus = CORPUS_DATA.get(game_name)
+    if corpus is None or corpus["stamps"] != stamps:
+        letter_arrays = [read_word_array(fname) for fname in fnames]
+        words, short_words = (letter_array_to_words(arr) for arr in letter_arrays)
+        corpus = {
+            "stamps": stamps,
+            "words": words,
+            "short_words": short_words,
+            "letter_arrays": letter_arrays,
+            "words_to_index": dict(zip(words, itertools.count(), strict=False)),
+            "priors": {},
+        }
+        CORPUS_DATA[game_name] = corpus
+    return corpus
+
+
+def get_word_list(game_name, short=False):
+    # A copy, since callers such as simulate_games shuffle it in place
+    return list(get_corpus(game_name)["short_words" if short else "words"])
+
+
+def get_letter_array(game_name, short=False):
+    """
+    Returns the letters of the word list of the game, as a read-only
+    (n_words, n_letters) uint8 array.
+    """
+    return get_corpus(game_name)["letter_arrays"][int(short)]
+
+
+def append_to_word_list(game_name, words):
+    """
+    Appends words to the full word list of the game, skipping the ones which
+    are already in it, and returns the words which were added. Their index
+    in the list is then after the index of every word already in it.
+    """
+    corpus = get_corpus(game_name)
+    word_length = corpus["letter_arrays"][0].shape[1]
+    if any(len(word) != word_length for word in words):
+        msg = f"The words of {game_name} must have {word_length} letters."
+        raise ValueError(msg)
+    new_words = [w for w in dict.fromkeys(words) if w not in corpus["words_to_index"]]
+    if new_words:
+        fname = Path(get_long_word_list_fname(game_name))
+        ends_with_newline = fname.read_bytes().endswith(b"\n")
+        with fname.open("a", encoding="utf8") as fp:
+            if not ends_with_newline:
+                fp.write("\n")
+            fp.writelines(f"{word}\n" for word in new_words)
+        # The binary version and the corpus are generated again, from the
+        # new word list, when next needed
+        get_word_array_fname(fname).unlink(missing_ok=True)
+        CORPUS_DATA.pop(game_name, None)
+        logging.info("Added %d words to %s", len(new_words), fname)
+    return new_words
+
+
 def get_word_frequencies(game_name, regenerate=False):
     word_freq_map_fname = get_word_freq_map_fname(game_name)
     if Path(word_freq_map_fname).exists() or regenerate:
@@ -44,37 +170,99 @@ def get_word_frequencies(game_name, regenerate=False):
     return freq_map
 
 
-def get_frequency_based_priors(game_name, n_common=3000, width_under_sigmoid=10):
+def get_sorted_frequency_priors(game_name, n_common, width_under_sigmoid):
     """
     We know that that list of wordle answers was curated by some human
     based on whether they're sufficiently common. This function aims
     to associate each word with the likelihood that it would actually
     be selected for the final answer.
 
-    Sort the words by frequency, then apply a sigmoid along it.
+    Sort the words by frequency, then apply a sigmoid along it. Returns
+    the sorted words, and their priors.
     """
-    freq_map = get_word_frequencies(game_name)
-    words = np.array(list(freq_map.keys()))
-    freq = np.array([freq_map[w] for w in words])
-    arg_sort = freq.argsort()
-    sorted_words = words[arg_sort]
+    cached_priors = get_corpus(game_name)["priors"]
+    key = ("frequency", n_common, width_under_sigmoid)
+    if key not in cached_priors:
+        freq_map = get_word_frequencies(game_name)
+        words = np.array(list(freq_map.keys()))
+        freq = np.fromiter(freq_map.values(), dtype=float, count=len(freq_map))
+        arg_sort = freq.argsort()
+        sorted_words = words[arg_sort]
+
+        # We want to imagine taking this sorted list, and putting it on a number
+        # line so that it's length is 10, situating it so that the n_common most common
+        # words are positive, then applying a sigmoid
+        x_width = width_under_sigmoid
+        c = x_width * (-0.5 + n_common / len(words))
+        xs = np.linspace(c - x_width / 2, c + x_width / 2, len(words))
+        cached_priors[key] = (sorted_words.tolist(), sigmoid(xs))
+    return cached_priors[key]
 
-    # We want to imagine taking this sorted list, and putting it on a number
-    # line so that it's length is 10, situating it so that the n_common most common
-    # words are positive, then applying a sigmoid
-    x_width = width_under_sigmoid
-    c = x_width * (-0.5 + n_common / len(words))
-    xs = np.linspace(c - x_width / 2, c + x_width / 2, len(words))
-    priors = {}
-    for word, x in zip(sorted_words, xs, strict=True):
-        priors[word] = sigmoid(x)
-    return priors
+
+def get_frequency_based_priors(game_name, n_common=3000, width_under_sigmoid=10):
+    sorted_words, priors = get_sorted_frequency_priors(
+        game_name,
+        n_common,
+        width_under_sigmoid,
+    )
+    return dict(zip(sorted_words, priors.tolist(), strict=True))
+
+
+def get_frequency_based_prior_array(
+    game_name,
+    n_common=3000,
+    width_under_sigmoid=10,
+    dtype=np.float32,
+):
+    """
+    Returns the frequency-based priors as a dense array aligned with the word
+    list of the game, with zeros for the words without a frequency.
+    """
+    corpus = get_corpus(game_name)
+    sorted_words, priors = get_sorted_frequency_priors(
+        game_name,
+        n_common,
+        width_under_sigmoid,
+    )
+    words_to_index = corpus["words_to_index"]
+    indices = np.array([words_to_index.get(w, -1) for w in sorted_words], dtype=int)
+    in_word_list = indices >= 0
+    prior_array = np.zeros(len(corpus["words"]), dtype=dtype)
+    prior_array[indices[in_word_list]] = priors[in_word_list]
+    return prior_array
+
+
+def get_true_wordle_prior_array(game_name, dtype=np.float32):
+    """
+    Returns the true prior as a dense array aligned with the word list of the
+    game, which is one for the words of the short list and zero otherwise.
+    """
+    corpus = get_corpus(game_name)
+    cached_priors = corpus["priors"]
+    if "true" not in cached_priors:
+        words_to_index = corpus["words_to_index"]
+        prior_array = np.zeros(len(corpus["words"]), dtype=bool)
+        prior_array[
+            [words_to_index[w] for w in corpus["short_words"] if w in words_to_index]
+        ] = True
+        cached_priors["true"] = prior_array
+        logging.debug("Priors: %d words with priors", len(prior_array))
+    return cached_priors["true"].astype(dtype)
 
 
 def get_true_wordle_prior(game_name):
-    words = get_word_list(game_name)
-    short_words = get_word_list(game_name, short=True)
-    priors = {w: int(w in short_words) for w in words}
-    print(f"Priors: {len(priors)} words with priors")  # Debugging line
-    return priors
+    words = get_corpus(game_name)["words"]
+    prior_array = get_true_wordle_prior_array(game_name, dtype=int)
+    return dict(zip(words, prior_array.tolist(), strict=True))
 
+
+def get_prior_array(priors, game_name):
+    """
+    Returns the priors as a dense float64 array aligned with the word list of
+    the game, given either such an array, e.g. in float32, or a dict mapping
+    words to priors.
+    """
+    if isinstance(priors, np.ndarray):
+        return np.asarray(priors, dtype=float)
+    words = get_corpus(game_name)["words"]
+    return np.array([priors.get(w, 0) for w in words], dtype=float)
@@ -1,16 +1,33 @@
+import time
+
 import numpy as np
 from tqdm import tqdm
 
+from src.cache import get_fingerprint
 from src.entropy import (
     entropy_of_distributions,
-    get_bucket_counts,
-    get_entropies,
-    get_pattern_distributions,
+    get_bucket_counts_from_indices,
+    get_bucket_entropies,
+    get_bucket_max_weights_from_indices,
+    get_entropies_from_indices,
+)
+from src.pattern import (
+    ALL_GREEN,
+    MAX_TRIVIAL_CANDIDATES,
+    get_index_buckets,
+    get_indexed_words,
+    get_pattern_matrix_from_indices,
+    get_word_indices,
 )
-from src.pattern import get_pattern, get_possible_words, get_word_buckets
-from src.prior import get_word_list
+from src.prior import get_prior_array
 
-# Solvers
+# Solvers. The core functions work on indices of words in the word list of the
+# game, and on priors as a dense array aligned with it, so that no per-word
+# work is done in Python. Wrappers take lists of words and dicts of priors.
+
+# Depth of a search which looks one guess ahead, and scores the buckets of
+# each guess with the expected scores of every guess at once
+ONE_GUESS_AHEAD_DEPTH = 2
 
 
 def get_weights(words, priors):
@@ -21,6 +38,14 @@ def get_weights(words, priors):
     return frequencies / total
 
 
+def get_weights_from_indices(indices, prior_array):
+    frequencies = prior_array[indices]
+    total = frequencies.sum()
+    if total == 0:
+        return np.zeros(frequencies.shape)
+    return frequencies / total
+
+
 def entropy_to_expected_score(ent):
     """
     Based on a regression associating entropies with typical scores
@@ -39,24 +64,62 @@ def entropy_to_expected_score(ent):
     return min_score + 1.5 * ent / 11.5
 
 
-def get_expected_scores(
-    allowed_words,
-    possible_words,
-    priors,
+def get_bucket_expected_scores(pattern_matrix, answer_rows, weights, bucket_ids):
+    """
+    The columns of pattern_matrix are possible answers, with positive weights,
+    split into buckets given by bucket_ids, and its rows are guesses. For each
+    guess and each bucket, this returns the expected score computed by
+    get_expected_scores_from_indices without looking ahead, along with the
+    weight of each bucket and the entropies after each guess within each
+    bucket. answer_rows is the row of each answer, or -1 if it is not a guess.
+    """
+    n_buckets = bucket_ids.max() + 1
+    dist = np.bincount(bucket_ids, weights=weights, minlength=n_buckets)
+
+    # Entropy of the answers within each bucket, and after each guess
+    h0s = np.log2(dist) - (
+        np.bincount(
+            bucket_ids,
+            weights=weights * np.log2(weights),
+            minlength=n_buckets,
+        )
+        / dist
+    )
+    h1s = get_bucket_entropies(pattern_matrix, bucket_ids, n_buckets, weights)
+
+    probs = np.zeros((len(pattern_matrix), n_buckets))
+    is_guess = answer_rows >= 0
+    probs[answer_rows[is_guess], bucket_ids[is_guess]] = (
+        weights[is_guess] / dist[bucket_ids[is_guess]]
+    )
+    scores = probs + (1 - probs) * (1 + entropy_to_expected_score(h0s - h1s))
+    return dist, h1s, scores
+
+
+def get_expected_scores_from_indices(
+    allowed_indices,
+    possible_indices,
+    prior_array,
     game_name,
     look_two_ahead=False,
     n_top_candidates_for_two_step=25,
 ):
-    
-    if len(possible_words) == 0:
+    if len(possible_indices) == 0:
         raise ValueError("No possible words available for guessing.")
     # Currently entropy of distribution
-    weights = get_weights(possible_words, priors)
+    weights = get_weights_from_indices(possible_indices, prior_array)
     h0 = entropy_of_distributions(weights)
-    h1s = get_entropies(allowed_words, possible_words, weights, game_name)
+    h1s = get_entropies_from_indices(
+        allowed_indices,
+        possible_indices,
+        weights,
+        game_name,
+    )
 
-    word_to_weight = dict(zip(possible_words, weights, strict=True))
-    probs = np.array([word_to_weight.get(w, 0) for w in allowed_words])
+    # Weight of each word of the game, which is zero if it is not possible
+    word_weights = np.zeros(len(prior_array))
+    word_weights[possible_indices] = weights
+    probs = word_weights[allowed_indices]
     # If this guess is the true answer, score is 1. Otherwise, it's 1 plus
     # the expected number of guesses it will take after getting the corresponding
     # amount of information.
@@ -65,56 +128,54 @@ def get_expected_scores(
     if not look_two_ahead:
         return expected_scores
 
-    # For the top candidates, refine the score by looking two steps out
-    # This is currently quite slow, and could be optimized to be faster.
-    # But why?
+    # For the top candidates, refine the score by looking two steps out.
+    # For each candidate, the best second guess of every bucket is chosen at
+    # once, from the entropies of all second guesses within all buckets,
+    # which are computed from the same pattern sub-matrix.
     sorted_indices = np.argsort(expected_scores)
-    allowed_second_guesses = get_word_list(game_name)
+    allowed_second_guesses = np.arange(len(prior_array))
+    # Answers with zero weight have no influence on the scores
+    nonzero = np.flatnonzero(weights)
+    possible_indices = np.asarray(possible_indices)[nonzero]
+    weights = weights[nonzero]
+    second_pattern_matrix = get_pattern_matrix_from_indices(
+        allowed_second_guesses,
+        possible_indices,
+        game_name,
+    )
     expected_scores += 1  # Push up the rest
     for i in tqdm(
         sorted_indices[:n_top_candidates_for_two_step],
         leave=False,
     ):
-        guess = allowed_words[i]
+        guess = allowed_indices[i]
         h1 = h1s[i]
-        dist = get_pattern_distributions([guess], possible_words, weights, game_name)[0]
-        buckets = get_word_buckets(guess, possible_words, game_name)
-        second_guesses = [
-            optimal_guess(
-                allowed_second_guesses,
-                bucket,
-                priors,
-                game_name=game_name,
-                look_two_ahead=False,
-            )
-            for bucket in buckets
-        ]
-        h2s = [
-            get_entropies([guess2], bucket, get_weights(bucket, priors), game_name)[0]
-            for guess2, bucket in zip(second_guesses, buckets, strict=True)
-        ]
-
-        prob = word_to_weight.get(guess, 0)
+        # Index of the bucket of each possible answer, among non-empty buckets
+        patterns = get_pattern_matrix_from_indices([guess], possible_indices, game_name)
+        _, bucket_ids = np.unique(patterns[0], return_inverse=True)
+        dist, h1s_after_guess, bucket_scores = get_bucket_expected_scores(
+            second_pattern_matrix,
+            possible_indices,
+            weights,
+            bucket_ids,
+        )
+        second_guesses = allowed_second_guesses[np.argmin(bucket_scores, axis=0)]
+        h2s = h1s_after_guess[second_guesses, np.arange(len(dist))]
+
+        prob = word_weights[guess]
+        prob2s = word_weights[second_guesses]
         expected_scores[i] = sum(
             (
                 # 1 times Probability guess1 is correct
                 1 * prob,
                 # 2 times probability guess2 is correct
-                2
-                * (1 - prob)
-                * sum(
-                    p * word_to_weight.get(g2, 0)
-                    for p, g2 in zip(dist, second_guesses, strict=True)
-                ),
+                2 * (1 - prob) * np.sum(dist * prob2s),
                 # 2 plus expected score two steps from now
                 (1 - prob)
                 * (
                     2
-                    + sum(
-                        p
-                        * (1 - word_to_weight.get(g2, 0))
-                        * entropy_to_expected_score(h0 - h1 - H2)
-                        for p, g2, H2 in zip(dist, second_guesses, h2s, strict=True)
+                    + np.sum(
+                        dist * (1 - prob2s) * entropy_to_expected_score(h0 - h1 - h2s),
                     )
                 ),
             ),
@@ -122,18 +183,58 @@ def get_expected_scores(
     return expected_scores
 
 
-def get_score_lower_bounds(allowed_words, possible_words, game_name):
+def get_expected_scores(
+    allowed_words,
+    possible_words,
+    priors,
+    game_name,
+    look_two_ahead=False,
+    n_top_candidates_for_two_step=25,
+):
+    return get_expected_scores_from_indices(
+        get_word_indices(allowed_words, game_name),
+        get_word_indices(possible_words, game_name),
+        get_prior_array(priors, game_name),
+        game_name,
+        look_two_ahead=look_two_ahead,
+        n_top_candidates_for_two_step=n_top_candidates_for_two_step,
+    )
+
+
+def get_score_lower_bounds_from_indices(
+    allowed_indices,
+    possible_indices,
+    game_name,
+    weights=None,
+):
     """
     Assuming a uniform distribution on how likely each element
-    of possible_words is, this gives a lower bound on the
-    possible score for each word in allowed_words
+    of possible_indices is, or else the given weights, this gives
+    a lower bound on the possible score for each word in allowed_indices
     """
-    if len(possible_words) == 0:
+    if len(possible_indices) == 0:
         raise ValueError("No possible words available for guessing.")
-    bucket_counts = get_bucket_counts(allowed_words, possible_words, game_name)
-    n = len(possible_words)
+    if weights is not None:
+        # At best, the most likely answer of each bucket is gotten in 2, and
+        # the guess itself, alone in the last bucket, is gotten in 1
+        max_weights = get_bucket_max_weights_from_indices(
+            allowed_indices,
+            possible_indices,
+            weights,
+            game_name,
+        )
+        p1s = max_weights[:, -1]
+        p2s = max_weights.sum(1) - p1s
+        p3s = 1 - p1s - p2s
+        return p1s + 2 * p2s + 3 * p3s
+    bucket_counts = get_bucket_counts_from_indices(
+        allowed_indices,
+        possible_indices,
+        game_name,
+    )
+    n = len(possible_indices)
     # Probabilities of getting it in 1
-    p1s = np.array([w in possible_words for w in allowed_words]) / n
+    p1s = np.isin(allowed_indices, possible_indices) / n
     # Probabilities of getting it in 2
     p2s = bucket_counts / n - p1s
     # Otherwise, assume it's gotten in 3 (which is optimistic)
@@ -141,97 +242,366 @@ def get_score_lower_bounds(allowed_words, possible_words, game_name):
     return p1s + 2 * p2s + 3 * p3s
 
 
-def optimal_guess(
-    allowed_words,
-    possible_words,
-    priors,
+def get_score_lower_bounds(allowed_words, possible_words, game_name):
+    return get_score_lower_bounds_from_indices(
+        get_word_indices(allowed_words, game_name),
+        get_word_indices(possible_words, game_name),
+        game_name,
+    )
+
+
+def get_search_budget(time_budget=None, node_budget=None):
+    """
+    Returns the budget of one look-ahead search: a number of seconds and a
+    number of guesses to play out, either of which can be None for no limit.
+    The search counts the guesses it plays out in the returned dict.
+    """
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+    return {"deadline": deadline, "node_budget": node_budget, "n_nodes": 0}
+
+
+def is_budget_exhausted(budget):
+    if budget["node_budget"] is not None and budget["n_nodes"] >= budget["node_budget"]:
+        return True
+    return budget["deadline"] is not None and time.monotonic() >= budget["deadline"]
+
+
+def get_search_value(
+    allowed_indices,
+    possible_indices,
+    prior_array,
+    game_name,
+    depth,
+    beam_width,
+    budget,
+):
+    """
+    Returns the expected number of guesses needed to find the answer among
+    possible_indices, including the next one, with the best guess found by
+    get_search_scores_from_indices.
+    """
+    if len(possible_indices) == 1:
+        return 1
+    if len(possible_indices) == MAX_TRIVIAL_CANDIDATES:
+        # Guess the most likely answer, then the other one
+        return 2 - get_weights_from_indices(possible_indices, prior_array).max()
+    scores = get_search_scores_from_indices(
+        allowed_indices,
+        possible_indices,
+        prior_array,
+        game_name,
+        depth=depth,
+        beam_width=beam_width,
+        budget=budget,
+    )
+    return scores.min()
+
+
+def get_search_scores_from_indices(
+    allowed_indices,
+    possible_indices,
+    prior_array,
+    game_name,
+    depth=2,
+    beam_width=25,
+    budget=None,
+):
+    """
+    Generalizes the look-ahead of get_expected_scores_from_indices to depth
+    guesses. The beam_width guesses with the best expected scores are played
+    out: each possible pattern leads to a bucket of answers, whose value is
+    searched recursively with one guess less, down to the expected scores of
+    get_expected_scores_from_indices at the last step. The same allowed words
+    are used at every step.
+
+    Guesses are played out from the most promising one, and skipped once their
+    lower bound is no better than the best score found so far. When the budget
+    is exhausted, the search stops expanding guesses, and the nodes left fall
+    back to the expected scores. Guesses which are not played out get an
+    infinite score.
+    """
+    if budget is None:
+        budget = get_search_budget()
+    allowed_indices = np.asarray(allowed_indices)
+    expected_scores = get_expected_scores_from_indices(
+        allowed_indices,
+        possible_indices,
+        prior_array,
+        game_name,
+    )
+    if depth <= 1 or is_budget_exhausted(budget):
+        return expected_scores
+
+    weights = get_weights_from_indices(possible_indices, prior_array)
+    # Answers with zero weight have no influence on the scores
+    nonzero = np.flatnonzero(weights)
+    if len(nonzero) == 0:
+        return expected_scores
+    possible_indices = np.asarray(possible_indices)[nonzero]
+    weights = weights[nonzero]
+    word_weights = np.zeros(len(prior_array))
+    word_weights[possible_indices] = weights
+    candidates = np.argsort(expected_scores, kind="stable")[:beam_width]
+    lower_bounds = get_score_lower_bounds_from_indices(
+        allowed_indices[candidates],
+        possible_indices,
+        game_name,
+        weights=weights,
+    )
+    if depth == ONE_GUESS_AHEAD_DEPTH:
+        # One guess ahead, the value of each bucket is the best expected score
+        # within it, which is computed for all buckets of a guess at once
+        pattern_matrix = get_pattern_matrix_from_indices(
+            allowed_indices,
+            possible_indices,
+            game_name,
+        )
+        word_rows = np.full(len(prior_array), -1)
+        word_rows[allowed_indices] = np.arange(len(allowed_indices))
+        answer_rows = word_rows[possible_indices]
+
+    scores = np.full(len(allowed_indices), np.inf)
+    best_score = np.inf
+    for i, lower_bound in zip(candidates, lower_bounds, strict=True):
+        if lower_bound >= best_score:
+            continue
+        if is_budget_exhausted(budget):
+            break
+        budget["n_nodes"] += 1
+        if depth == ONE_GUESS_AHEAD_DEPTH:
+            patterns, bucket_ids = np.unique(pattern_matrix[i], return_inverse=True)
+            dist, _, bucket_scores = get_bucket_expected_scores(
+                pattern_matrix,
+                answer_rows,
+                weights,
+                bucket_ids,
+            )
+            values = 1 + bucket_scores.min(axis=0)
+            # The guess is the answer
+            values[patterns == ALL_GREEN] = 1
+            score = np.sum(dist * values)
+        else:
+            score = 0
+            buckets = get_index_buckets(allowed_indices[i], possible_indices, game_name)
+            for pattern, bucket in enumerate(buckets):
+                if len(bucket) == 0:
+                    continue
+                bucket_weight = word_weights[bucket].sum()
+                if pattern == ALL_GREEN:
+                    # The guess is the answer
+                    score += bucket_weight
+                    continue
+                score += bucket_weight * (
+                    1
+                    + get_search_value(
+                        allowed_indices,
+                        bucket,
+                        prior_array,
+                        game_name,
+                        depth - 1,
+                        beam_width,
+                        budget,
+                    )
+                )
+        scores[i] = score
+        best_score = min(best_score, score)
+
+    if np.isinf(best_score):
+        return expected_scores
+    return scores
+
+
+def optimal_guess_from_indices(
+    allowed_indices,
+    possible_indices,
+    prior_array,
     game_name,
     look_two_ahead=False,
     optimize_for_uniform_distribution=False,
     purely_maximize_information=False,
+    search_depth=None,
+    beam_width=25,
+    time_budget=None,
+    node_budget=None,
 ):
+    """
+    Returns the index of the best guess among allowed_indices, where both
+    allowed_indices and possible_indices are arrays of indices in the word
+    list of the game, and prior_array is aligned with that word list.
+
+    With search_depth, guesses are chosen by a look-ahead search over that
+    many guesses, keeping beam_width candidates at each step, within
+    time_budget seconds and node_budget played out guesses per decision.
+    beam_width is also the number of candidates of look_two_ahead.
+    """
     if purely_maximize_information:
-        if len(possible_words) == 1:
-            return possible_words[0]
-        weights = get_weights(possible_words, priors)
-        entropies = get_entropies(allowed_words, possible_words, weights, game_name)
-        return allowed_words[np.argmax(entropies)]
+        if len(possible_indices) == 1:
+            return possible_indices[0]
+        weights = get_weights_from_indices(possible_indices, prior_array)
+        entropies = get_entropies_from_indices(
+            allowed_indices,
+            possible_indices,
+            weights,
+            game_name,
+        )
+        return allowed_indices[np.argmax(entropies)]
 
-    if len(allowed_words) == 0:
+    if len(allowed_indices) == 0:
         raise ValueError("No allowed words available.")
-        
+
     if optimize_for_uniform_distribution:
-        expected_scores = get_score_lower_bounds(
-            allowed_words,
-            possible_words,
+        expected_scores = get_score_lower_bounds_from_indices(
+            allowed_indices,
+            possible_indices,
+            game_name,
+        )
+    elif search_depth is not None:
+        expected_scores = get_search_scores_from_indices(
+            allowed_indices,
+            possible_indices,
+            prior_array,
             game_name,
+            depth=search_depth,
+            beam_width=beam_width,
+            budget=get_search_budget(time_budget, node_budget),
         )
     else:
-        expected_scores = get_expected_scores(
-            allowed_words,
-            possible_words,
-            priors,
+        expected_scores = get_expected_scores_from_indices(
+            allowed_indices,
+            possible_indices,
+            prior_array,
             game_name=game_name,
             look_two_ahead=look_two_ahead,
+            n_top_candidates_for_two_step=beam_width,
         )
-    
+
     if len(expected_scores) == 0:
         raise ValueError("No expected scores calculated for argmin.")
 
-    return allowed_words[np.argmin(expected_scores)]
-
+    return allowed_indices[np.argmin(expected_scores)]
 
 
-def brute_force_optimal_guess(
-    all_words,
+def optimal_guess(
+    allowed_words,
     possible_words,
     priors,
     game_name,
+    look_two_ahead=False,
+    optimize_for_uniform_distribution=False,
+    purely_maximize_information=False,
+    search_depth=None,
+    beam_width=25,
+    time_budget=None,
+    node_budget=None,
+):
+    index = optimal_guess_from_indices(
+        get_word_indices(allowed_words, game_name),
+        get_word_indices(possible_words, game_name),
+        get_prior_array(priors, game_name),
+        game_name,
+        look_two_ahead=look_two_ahead,
+        optimize_for_uniform_distribution=optimize_for_uniform_distribution,
+        purely_maximize_information=purely_maximize_information,
+        search_depth=search_depth,
+        beam_width=beam_width,
+        time_budget=time_budget,
+        node_budget=node_budget,
+    )
+    return get_indexed_words([index], game_name)[0]
+
+
+def brute_force_optimal_guess_from_indices(
+    allowed_indices,
+    possible_indices,
+    prior_array,
+    game_name,
     n_top_picks=10,
     display_progress=False,
+    playout_cache=None,
 ):
-    if len(possible_words) == 0:
+    """
+    Plays the game out from this point for the guesses with the best lower
+    bounds, with optimal_guess for uniform distributions afterwards, and
+    returns the one with the best average score.
+
+    The answers which lead to the same candidates get the same guesses from
+    then on, so playouts walk the buckets of each guess rather than each
+    answer, and the guess for each set of candidates is looked up in
+    playout_cache, which can be shared across calls.
+    """
+    if len(possible_indices) == 0:
         # Doesn't matter what to return in this case, so just default to first word in list.
-        return all_words[0]
+        return allowed_indices[0]
+    if playout_cache is None:
+        playout_cache = {}
+    allowed_key = get_fingerprint(allowed_indices)
+
+    def get_playout_guess(candidates):
+        key = (allowed_key, get_fingerprint(np.sort(candidates)))
+        if key not in playout_cache:
+            playout_cache[key] = optimal_guess_from_indices(
+                allowed_indices,
+                candidates,
+                prior_array,
+                game_name,
+                optimize_for_uniform_distribution=True,
+            )
+        return playout_cache[key]
+
+    def get_total_score(guess, candidates):
+        # Every answer takes this guess, and the ones which are not the guess
+        # take the guesses played out in their bucket
+        total_score = len(candidates)
+        buckets = get_index_buckets(guess, candidates, game_name)
+        for pattern, bucket in enumerate(buckets):
+            if len(bucket) == 0 or pattern == ALL_GREEN:
+                continue
+            total_score += get_total_score(get_playout_guess(bucket), bucket)
+        return total_score
+
     # For the suggestions with the top expected scores, just
     # actually play the game out from this point to see what
     # their actual scores are, and minimize.
-    expected_scores = get_score_lower_bounds(all_words, possible_words, game_name)
-    top_choices = [all_words[i] for i in np.argsort(expected_scores)[:n_top_picks]]
-    true_average_scores = []
+    expected_scores = get_score_lower_bounds_from_indices(
+        allowed_indices,
+        possible_indices,
+        game_name,
+    )
+    top_choices = np.asarray(allowed_indices)[np.argsort(expected_scores)[:n_top_picks]]
     if display_progress:
         iterable = tqdm(
             top_choices,
-            desc=f"Possibilities: {len(possible_words)}",
+            desc=f"Possibilities: {len(possible_indices)}",
             leave=False,
         )
     else:
         iterable = top_choices
 
-    for next_guess in iterable:
-        scores = []
-        for answer in possible_words:
-            score = 1
-            possibilities = list(possible_words)
-            guess = next_guess
-            while guess != answer:
-                possibilities = get_possible_words(
-                    guess,
-                    get_pattern(guess, answer, game_name),
-                    possibilities,
-                    game_name,
-                )
-                # Make recursive? If so, we'd want to keep track of
-                # the next_guess map and pass it down in the recursive
-                # sub-calls
-                guess = optimal_guess(
-                    all_words,
-                    possibilities,
-                    priors,
-                    game_name=game_name,
-                    optimize_for_uniform_distribution=True,
-                )
-                score += 1
-            scores.append(score)
-        true_average_scores.append(np.mean(scores))
-    return top_choices[np.argmin(true_average_scores)]
+    true_total_scores = [
+        get_total_score(next_guess, possible_indices) for next_guess in iterable
+    ]
+    return top_choices[np.argmin(true_total_scores)]
+
+
+def brute_force_optimal_guess(
+    all_words,
+    possible_words,
+    priors,
+    game_name,
+    n_top_picks=10,
+    display_progress=False,
+    playout_cache=None,
+):
+    if len(possible_words) == 0:
+        # Doesn't matter what to return in this case, so just default to first word in list.
+        return all_words[0]
+    index = brute_force_optimal_guess_from_indices(
+        get_word_indices(all_words, game_name),
+        get_word_indices(possible_words, game_name),
+        get_prior_array(priors, game_name),
+        game_name,
+        n_top_picks=n_top_picks,
+        display_progress=display_progress,
+        playout_cache=playout_cache,
+    )
+    return get_indexed_words([index], game_name)[0]